@@ -0,0 +1,463 @@
+"""Offline load test for the bot.
+
+Starts local stand-ins for the Telegram Bot API and OpenWeatherMap, seeds a
+throwaway SQLite database with synthetic users and events spread over many
+timezones, then drives /setcity, /addevent, /myevents and the daily dispatch
+through the real Application and handlers. Nothing leaves the machine.
+
+    python bench.py --users 10000 --ops 2000 --concurrency 50 > bench_output.txt
+
+With --workers N it instead starts N `BOT_MODE=worker` processes sharing one
+database and checks that every due event is sent exactly once.
+
+    python bench.py --workers 3 --users 5000
+"""
+import argparse
+import asyncio
+import os
+import random
+import re
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import zoneinfo
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+
+from aiohttp import web
+
+CITIES = [  # name, country, lat, lon
+    ("Berlin", "DE", 52.52, 13.40), ("London", "GB", 51.51, -0.13), ("Moscow", "RU", 55.76, 37.62),
+    ("New York", "US", 40.71, -74.01), ("Los Angeles", "US", 34.05, -118.24), ("Tokyo", "JP", 35.68, 139.69),
+    ("Sydney", "AU", -33.87, 151.21), ("Sao Paulo", "BR", -23.55, -46.63), ("Cairo", "EG", 30.04, 31.24),
+    ("Delhi", "IN", 28.61, 77.21), ("Novosibirsk", "RU", 55.03, 82.92), ("Vladivostok", "RU", 43.12, 131.89),
+    ("Paris", "FR", 48.86, 2.35), ("Madrid", "ES", 40.42, -3.70), ("Istanbul", "TR", 41.01, 28.98),
+    ("Dubai", "AE", 25.20, 55.27), ("Singapore", "SG", 1.35, 103.82), ("Mexico City", "MX", 19.43, -99.13),
+    ("Toronto", "CA", 43.65, -79.38), ("Auckland", "NZ", -36.85, 174.76),
+]
+
+ADD_EVENT_PHRASES = [
+    "Dentist tomorrow", "Gym in 3 days", "Lesson next friday", "Trip in 2 weeks",
+    "Встреча завтра", "Поездка через 3 дня", "Врач в пятницу",
+    "Conference {date}", "Отпуск {date}",
+    "Party on the 5th of May",  # no fast-path rule: goes to the dateparser pool
+]
+
+def parse_args():
+    p = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    p.add_argument("--users", type=int, default=10000, help="synthetic users to seed")
+    p.add_argument("--events-per-user", type=int, default=3)
+    p.add_argument("--due-share", type=float, default=0.3, help="share of events due today (local)")
+    p.add_argument("--zones", type=int, default=60, help="distinct timezones among users")
+    p.add_argument("--ops", type=int, default=2000, help="updates per command scenario")
+    p.add_argument("--concurrency", type=int, default=50, help="updates processed at once")
+    p.add_argument("--tg-latency", type=float, default=0.0, help="stand-in Bot API latency, ms")
+    p.add_argument("--owm-latency", type=float, default=0.0, help="stand-in OWM latency, ms")
+    p.add_argument("--send-rate", type=float, default=1e6,
+                   help="SEND_RATE for the run (default: effectively unlimited, measures the bot itself)")
+    p.add_argument("--paced-chats", type=int, default=100, help="single-message chats in the paced-send scenario")
+    p.add_argument("--paced-interval", type=float, default=1.0,
+                   help="per-chat interval for that scenario (the bot's default SEND_CHAT_INTERVAL)")
+    p.add_argument("--paced-heavy", type=int, default=20,
+                   help="messages queued up front for each of the first 10 chats in that scenario")
+    p.add_argument("--workers", type=int, default=0,
+                   help="run the multi-process shard check with this many worker processes instead")
+    p.add_argument("--shards", type=int, default=16, help="SHARD_COUNT for --workers")
+    p.add_argument("--timeout", type=float, default=120.0, help="how long --workers waits for delivery, s")
+    p.add_argument("--db", help="database file to use (default: a temporary one)")
+    p.add_argument("--seed", type=int, default=42)
+    return p.parse_args()
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+# ---------- stand-ins ----------
+class FakeUpstreams:
+    """Minimal Bot API + OpenWeatherMap served from one local aiohttp app; counts every call."""
+
+    def __init__(self, tg_latency: float, owm_latency: float):
+        self.tg_latency = tg_latency
+        self.owm_latency = owm_latency
+        self.calls = Counter()
+        self.sent = Counter()  # message text -> times sent
+        self._message_id = 0
+
+    def web_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self.telegram)
+        app.router.add_get("/geo/1.0/direct", self.geocode)
+        app.router.add_get("/data/2.5/weather", self.weather)
+        return app
+
+    async def telegram(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        self.calls[f"telegram {method}"] += 1
+        if self.tg_latency:
+            await asyncio.sleep(self.tg_latency)
+        if request.content_type == "application/json":
+            params = await request.json()
+        else:
+            params = dict(await request.post())
+        if method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+        elif method == "sendMessage":
+            self.sent[params.get("text", "")] += 1
+            self._message_id += 1
+            result = {
+                "message_id": self._message_id,
+                "date": int(time.time()),
+                "chat": {"id": int(params["chat_id"]), "type": "private"},
+                "text": params.get("text", ""),
+            }
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    async def geocode(self, request: web.Request) -> web.Response:
+        self.calls["owm geocode"] += 1
+        if self.owm_latency:
+            await asyncio.sleep(self.owm_latency)
+        q = request.query.get("q", "").split(",")[0].strip().lower()
+        hits = [{"name": n, "country": c, "lat": lat, "lon": lon} for n, c, lat, lon in CITIES if n.lower() == q]
+        return web.json_response(hits[:1])
+
+    async def weather(self, request: web.Request) -> web.Response:
+        self.calls["owm weather"] += 1
+        if self.owm_latency:
+            await asyncio.sleep(self.owm_latency)
+        lat, lon = float(request.query["lat"]), float(request.query["lon"])
+        seed = int(abs(lat * 100) + abs(lon * 10))
+        return web.json_response({
+            "weather": [{"description": ("light rain", "clear sky", "overcast clouds", "snow")[seed % 4]}],
+            "main": {"temp": -5 + seed % 35, "feels_like": -7 + seed % 35},
+            "wind": {"speed": seed % 15},
+            "clouds": {"all": seed % 100},
+            "rain": {"1h": 0.4} if seed % 4 == 0 else None,
+        })
+
+# ---------- data ----------
+def pick_zones(n: int, rng: random.Random) -> list[tuple[str, float, float]]:
+    names = sorted(z for z in zoneinfo.available_timezones() if "/" in z and not z.startswith(("Etc/", "SystemV/")))
+    return [(tz, rng.uniform(-60, 70), rng.uniform(-180, 180)) for tz in rng.sample(names, min(n, len(names)))]
+
+def seed_db(args, zones, rng: random.Random):
+    import db
+    from tztools import local_date
+    now = datetime.now(timezone.utc)
+    stamp = now.isoformat()
+    users, events, due = [], [], 0
+    for uid in range(1, args.users + 1):
+        tz, lat, lon = zones[uid % len(zones)]
+        # users of one zone cluster around one place, like a real city
+        users.append((uid, f"City of {tz}", lat + rng.uniform(-0.05, 0.05), lon + rng.uniform(-0.05, 0.05),
+                      tz, rng.choice(("en", "ru")), stamp))
+        today = local_date(tz, now)
+        for k in range(args.events_per_user):
+            if rng.random() < args.due_share:
+                d, due = today, due + 1
+            else:
+                d = today + timedelta(days=rng.randint(1, 365))
+            events.append((uid, f"Event {uid}-{k}", d.isoformat(), stamp))
+    with db.db() as conn:
+        conn.executemany("""
+            INSERT INTO users (user_id, city, lat, lon, timezone, lang, created_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        """, users)
+        conn.executemany("""
+            INSERT INTO events (user_id, title, event_date, created_at)
+            VALUES (?, ?, ?, ?)
+        """, events)
+        conn.commit()
+    return due
+
+def command_update(bot, update_id: int, user_id: int, text: str):
+    from telegram import Update
+    command = text.split()[0]
+    return Update.de_json({
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": f"User{user_id}"},
+            "text": text,
+            "entities": [{"type": "bot_command", "offset": 0, "length": len(command)}],
+        },
+    }, bot)
+
+# ---------- scenarios ----------
+class Result:
+    def __init__(self, name: str):
+        self.name = name
+        self.latencies: list[float] = []
+        self.wall = 0.0
+        self.db: dict[str, list] = {}
+        self.calls = Counter()
+        self.extra = ""
+
+    def pct(self, q: float) -> float:
+        xs = sorted(self.latencies)
+        return xs[min(len(xs) - 1, int(q * len(xs)))] * 1000 if xs else 0.0
+
+@contextmanager
+def recording(upstreams: FakeUpstreams, result: Result):
+    # Wall time plus the DB and upstream counters accumulated while the block runs.
+    import db
+    db0 = {k: list(v) for k, v in db.QUERY_STATS.items()}
+    calls0 = Counter(upstreams.calls)
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        result.wall = time.perf_counter() - t0
+        for k, (n, secs) in db.QUERY_STATS.items():
+            n0, secs0 = db0.get(k, (0, 0.0))
+            if n > n0:
+                result.db[k] = [n - n0, secs - secs0]
+        result.calls = upstreams.calls - calls0
+
+async def run_commands(app, upstreams: FakeUpstreams, name: str, make_text, user_ids, ops: int,
+                       concurrency: int, rng: random.Random) -> Result:
+    result = Result(name)
+    sem = asyncio.Semaphore(concurrency)
+    updates = [command_update(app.bot, i, rng.choice(user_ids), make_text(rng)) for i in range(1, ops + 1)]
+
+    async def one(update):
+        async with sem:
+            start = time.perf_counter()
+            await app.process_update(update)
+            result.latencies.append(time.perf_counter() - start)
+
+    with recording(upstreams, result):
+        await asyncio.gather(*(one(u) for u in updates))
+    return result
+
+async def run_dispatch(app, upstreams: FakeUpstreams, zones) -> Result:
+    from telegram.ext import CallbackContext
+    from handlers import dispatch_timezone
+    result = Result("daily dispatch")
+    context = CallbackContext(app)
+    with recording(upstreams, result):
+        for tz, _, _ in zones:
+            start = time.perf_counter()
+            await dispatch_timezone(context, tz)
+            result.latencies.append(time.perf_counter() - start)
+        await app.bot_data["send_queue"].join()
+    return result
+
+async def run_paced_sends(app, upstreams: FakeUpstreams, args) -> Result:
+    # The real per-chat pacing: a few chats with many messages are queued ahead of many
+    # chats with one each, like users with several events due at 08:00. With fair
+    # pacing, the single messages go out at the send rate instead of waiting behind them.
+    from sender import SendQueue
+    result = Result("paced sends")
+    queue = SendQueue(app.bot, rate=30.0, burst=30, chat_interval=args.paced_interval)
+    queue.start()
+
+    async def timed(fut, start):
+        await fut
+        result.latencies.append(time.perf_counter() - start)
+
+    with recording(upstreams, result):
+        start = time.perf_counter()
+        heavy = [queue.send(chat, f"heavy {i}") for chat in range(1, 11) for i in range(args.paced_heavy)]
+        light = [queue.send(chat, "light") for chat in range(11, 11 + args.paced_chats)]
+        await asyncio.gather(*(timed(f, start) for f in light))
+        result.extra = f"{len(light)} single messages delivered in {time.perf_counter() - start:.2f}s " \
+                       f"at 30/s behind {len(heavy)} messages for 10 chats ({args.paced_interval}s per-chat interval)"
+        await queue.stop(timeout=0)
+    return result
+
+def report(results: list[Result], extra: dict):
+    print("\n== Throughput and latency ==")
+    print(f"{'scenario':<16}{'ops':>8}{'wall s':>9}{'ops/s':>10}{'p50 ms':>9}{'p90 ms':>9}{'p99 ms':>9}{'max ms':>9}")
+    for r in results:
+        n = len(r.latencies)
+        print(f"{r.name:<16}{n:>8}{r.wall:>9.2f}{n / r.wall if r.wall else 0:>10.1f}"
+              f"{r.pct(0.5):>9.2f}{r.pct(0.9):>9.2f}{r.pct(0.99):>9.2f}{r.pct(1.0):>9.2f}")
+    print("  (daily dispatch: one op = one timezone; wall includes draining the send queue)")
+    print("  (paced sends: one op = one single-message chat, latency from enqueue to delivery)")
+    for r in results:
+        if r.extra:
+            print(f"  {r.name}: {r.extra}")
+
+    print("\n== DB time (executing, per query) ==")
+    for r in results:
+        total = sum(s for _, s in r.db.values())
+        print(f"{r.name}: {total * 1000:.1f} ms total")
+        for k, (n, secs) in sorted(r.db.items(), key=lambda kv: -kv[1][1]):
+            print(f"    {k:<24}{n:>8} calls{secs * 1000:>10.1f} ms{secs / n * 1e6:>10.1f} us/call")
+
+    print("\n== Outbound calls ==")
+    for r in results:
+        calls = ", ".join(f"{k}={v}" for k, v in sorted(r.calls.items())) or "none"
+        print(f"{r.name}: {calls}")
+
+    print("\n== Other ==")
+    for k, v in extra.items():
+        print(f"{k}: {v}")
+
+async def main_async(args):
+    rng = random.Random(args.seed)
+    upstreams = FakeUpstreams(args.tg_latency / 1000, args.owm_latency / 1000)
+    port = free_port()
+    runner = web.AppRunner(upstreams.web_app())
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", port).start()
+
+    # config.py reads the environment at import time, so point it at the stand-ins first.
+    base = f"http://127.0.0.1:{port}"
+    os.environ.update({
+        "DB_PATH": args.db or os.path.join(tempfile.mkdtemp(prefix="bench-"), "bench.db"),
+        "TELEGRAM_BASE_URL": base,
+        "OWM_BASE_URL": base,
+        "OWM_API_KEY": "bench",
+        "SEND_RATE": str(args.send_rate),
+        "SEND_BURST": str(max(1, int(min(args.send_rate, 1e5)))),
+        "SEND_CHAT_INTERVAL": "0",
+    })
+    import db
+    from bot import build_application
+    from parsing import parse_event_args_async, FAST_PATH_STATS, POOL_STATS
+    from weather import WEATHER_CACHE
+
+    db.init_db()
+    zones = pick_zones(args.zones, rng)
+    t0 = time.perf_counter()
+    due = seed_db(args, zones, rng)
+    seeded = f"{args.users} users, {args.users * args.events_per_user} events ({due} due today) " \
+             f"in {len(zones)} timezones, {time.perf_counter() - t0:.2f}s"
+    print(f"DB: {os.environ['DB_PATH']}\nSeeded {seeded}")
+
+    app = build_application("123456:BENCH")
+    await app.initialize()
+    await app.post_init(app)
+    await parse_event_args_async("warm up on the 5th of May", "UTC", "en")  # wait for a warm parser worker
+
+    user_ids = list(range(1, args.users + 1))
+    future = (datetime.now(timezone.utc) + timedelta(days=30)).strftime("%d.%m.%Y")
+    results = [
+        await run_commands(app, upstreams, "/setcity", lambda r: f"/setcity {r.choice(CITIES)[0]}",
+                           user_ids, args.ops, args.concurrency, rng),
+        await run_commands(app, upstreams, "/addevent",
+                           lambda r: "/addevent " + r.choice(ADD_EVENT_PHRASES).format(date=future),
+                           user_ids, args.ops, args.concurrency, rng),
+        await run_commands(app, upstreams, "/myevents", lambda r: "/myevents",
+                           user_ids, args.ops, args.concurrency, rng),
+        await run_dispatch(app, upstreams, zones),
+        await run_paced_sends(app, upstreams, args),
+    ]
+
+    await app.post_stop(app)
+    await app.shutdown()
+    await app.post_shutdown(app)
+    await runner.cleanup()
+
+    report(results, {
+        "seeded": seeded,
+        "fast-path dates": dict(FAST_PATH_STATS),
+        "dateparser pool": dict(POOL_STATS),
+        "weather cache": f"{WEATHER_CACHE.hits} hits / {WEATHER_CACHE.misses} misses, {len(WEATHER_CACHE)} cells",
+    })
+
+# ---------- multi-process shard check ----------
+TITLE_RE = re.compile(r"\*\*(.+?)\*\*")
+
+async def sharded_async(args):
+    # Every zone used is already past 08:00 locally, so each worker's catch-up for the
+    # shards it leases sends that day's events; the stand-in records every message.
+    rng = random.Random(args.seed)
+    upstreams = FakeUpstreams(args.tg_latency / 1000, args.owm_latency / 1000)
+    port = free_port()
+    runner = web.AppRunner(upstreams.web_app())
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", port).start()
+
+    base = f"http://127.0.0.1:{port}"
+    env = {
+        **os.environ,
+        "DB_PATH": args.db or os.path.join(tempfile.mkdtemp(prefix="bench-"), "bench.db"),
+        "TELEGRAM_BOT_TOKEN": "123456:BENCH",
+        "TELEGRAM_BASE_URL": base,
+        "OWM_BASE_URL": base,
+        "OWM_API_KEY": "bench",
+        "BOT_MODE": "worker",
+        "SHARD_COUNT": str(args.shards),
+        "LEASE_TTL": "6",
+        "LEASE_RENEW": "2",
+        "PREFETCH_LEAD": "0",
+        "SEND_RATE": str(args.send_rate),
+        "SEND_BURST": str(max(1, int(min(args.send_rate, 1e5)))),
+        "SEND_CHAT_INTERVAL": "0",
+    }
+    os.environ.update(env)
+    import db
+    from tztools import local_date
+
+    db.init_db()
+    now = datetime.now(timezone.utc)
+    zones = [z for z in pick_zones(400, rng) if now.astimezone(zoneinfo.ZoneInfo(z[0])).hour >= 8][:args.zones]
+    seed_db(args, zones, rng)
+    expected = set()
+    with db.db() as conn:
+        for tz, _, _ in zones:
+            expected.update(r[0] for r in conn.execute("""
+                SELECT e.title FROM events e JOIN users u ON u.user_id = e.user_id
+                WHERE u.timezone = ? AND e.event_date = ?
+            """, (tz, local_date(tz, now).isoformat())))
+    print(f"DB: {env['DB_PATH']}\n{args.users} users in {len(zones)} zones past 08:00, "
+          f"{len(expected)} events due; starting {args.workers} workers on {args.shards} shards")
+
+    bot_py = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bot.py")
+    procs = [subprocess.Popen([sys.executable, bot_py], env={**env, "WORKER_ID": f"bench-{i}"},
+                              stdout=subprocess.DEVNULL)
+             for i in range(args.workers)]
+    start = time.perf_counter()
+
+    def delivered() -> Counter:
+        return Counter(m.group(1) for text, n in upstreams.sent.items()
+                       for m in [TITLE_RE.search(text)] if m for _ in range(n))
+
+    try:
+        while time.perf_counter() - start < args.timeout and not expected <= set(delivered()):
+            await asyncio.sleep(0.5)
+        took = time.perf_counter() - start
+        await asyncio.sleep(3 * float(env["LEASE_RENEW"]))  # let rebalancing run; a late duplicate would show up
+    finally:
+        for proc in procs:
+            proc.send_signal(signal.SIGTERM)
+        for proc in procs:
+            try:
+                proc.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+        await runner.cleanup()
+
+    sent = delivered()
+    duplicates = {title: n for title, n in sent.items() if n > 1}
+    missing = expected - set(sent)
+    with db.db() as conn:
+        owners = conn.execute("SELECT owner, COUNT(*) FROM shard_leases GROUP BY owner").fetchall()
+    print(f"delivered {len(set(sent) & expected)}/{len(expected)} in {took:.2f}s, "
+          f"{sum(duplicates.values()) - len(duplicates)} duplicate(s), {len(missing)} missing")
+    print("leases left at exit:", {o: n for o, n in owners} or "none (all released)")
+    for title in sorted(missing)[:10]:
+        print("  missing:", title)
+    for title, n in sorted(duplicates.items())[:10]:
+        print(f"  sent {n}x:", title)
+    return not duplicates and not missing
+
+def main():
+    args = parse_args()
+    if args.workers:
+        sys.exit(0 if asyncio.run(sharded_async(args)) else 1)
+    asyncio.run(main_async(args))
+
+if __name__ == "__main__":
+    main()
@@ -1,43 +1,189 @@
+import time
+_BOOT = time.perf_counter()
+
+import asyncio
+import sys
 from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, filters
-from config import ensure_env
-from db import init_db, list_all_users
+from urllib.parse import urlsplit
+from config import (
+    ensure_env, log, WARMUP_ON_START, TELEGRAM_BASE_URL, METRICS_HOST, METRICS_PORT,
+    BOT_MODE, CONCURRENT_UPDATES, WEBHOOK_URL, WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_PATH, WEBHOOK_SECRET,
+    SHARD_COUNT, WORKER_ID, LEASE_RENEW, ARCHIVE_AFTER_DAYS, ARCHIVE_INTERVAL, CATCHUP_ON_START
+)
+from db import init_db, close_db, list_timezones, release_shards, claim_events, release_events, USER_CACHE
+from weather import create_owm_session, WEATHER_CACHE, OWM_BREAKER
+from metrics import (
+    start_metrics_server, SEND_QUEUE_DEPTH, WEATHER_CACHE_HITS, WEATHER_CACHE_MISSES, OWM_CIRCUIT_OPEN,
+    USER_CACHE_HITS, USER_CACHE_MISSES, DATE_FAST_HITS, DATE_FAST_MISSES,
+    PARSER_REJECTED, PARSER_TIMEOUTS
+)
+from sender import SendQueue
+from updates import PerUserUpdateProcessor
+from parsing import start_parser_pool, stop_parser_pool, FAST_PATH_STATS, POOL_STATS
+from tztools import timezone_finder
 from handlers import (
     cmd_start, cmd_language, on_language_pick,
-    cmd_setcity, cmd_addevent, cmd_myevents, cmd_delete, cmd_checktoday,
-    cmd_ping, debug_echo, schedule_user_daily_job
+    cmd_setcity, cmd_addevent, cmd_myevents, cmd_delete, cmd_checktoday, cmd_import, cmd_export,
+    cmd_ping, debug_echo, schedule_timezone_job, shard_lease_callback, on_events_page, archive_callback,
+    catch_up_callback
 )
 
-def main():
-    token = ensure_env("TELEGRAM_BOT_TOKEN")
-    # OWM_API_KEY is checked lazily inside handlers/weather path
+def peak_rss_mb() -> float | None:
+    try:
+        import resource
+    except ImportError:  # Windows
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024 * 1024) if sys.platform == "darwin" else rss / 1024
 
-    init_db()
+def log_boot_stats(stage: str):
+    rss = peak_rss_mb()
+    log.info("%s after %.0f ms (peak RSS %s)", stage, (time.perf_counter() - _BOOT) * 1000,
+             f"{rss:.1f} MB" if rss is not None else "n/a")
 
-    app = Application.builder().token(token).build()
+def warm_up():
+    # dateparser is warmed inside the parser pool's worker processes.
+    try:
+        timezone_finder()
+    except Exception as ex:
+        log.exception("Warm-up failed (will load on first use): %s", ex)
+        return
+    log_boot_stats("Warm-up finished")
+
+def build_application(token: str) -> Application:
+    builder = Application.builder().token(token)
+    if TELEGRAM_BASE_URL:
+        # Self-hosted Bot API server (or the local stand-in used by bench.py)
+        builder = builder.base_url(f"{TELEGRAM_BASE_URL}/bot").base_file_url(f"{TELEGRAM_BASE_URL}/file/bot")
+    if CONCURRENT_UPDATES > 1:
+        builder = builder.concurrent_updates(PerUserUpdateProcessor(CONCURRENT_UPDATES))
+    app = builder.build()
 
     # Commands
     app.add_handler(CommandHandler("start", cmd_start))
     app.add_handler(CommandHandler("language", cmd_language))
     app.add_handler(CallbackQueryHandler(on_language_pick, pattern=r"^lang:(en|ru)$"))
+    app.add_handler(CallbackQueryHandler(on_events_page, pattern=r"^ev:[np]:"))
 
     app.add_handler(CommandHandler("setcity", cmd_setcity))
     app.add_handler(CommandHandler("addevent", cmd_addevent))
     app.add_handler(CommandHandler("myevents", cmd_myevents))
     app.add_handler(CommandHandler("delete", cmd_delete))
     app.add_handler(CommandHandler("checktoday", cmd_checktoday))
+    app.add_handler(CommandHandler("import", cmd_import))
+    app.add_handler(MessageHandler(filters.Document.ALL & filters.CaptionRegex(r"^/import(@\w+)?\b"), cmd_import))
+    app.add_handler(CommandHandler("export", cmd_export))
 
     # Debug
     app.add_handler(CommandHandler("ping", cmd_ping))
     app.add_handler(MessageHandler(filters.ALL, debug_echo))
 
-    # Recreate daily jobs for all existing users on startup
+    # Recreate one daily job per known timezone on startup
     async def _post_init(app_):
-        for u in list_all_users():
-            await schedule_user_daily_job(app_.job_queue, u["user_id"], u["timezone"])
+        app_.bot_data["owm_session"] = create_owm_session()
+        app_.bot_data["send_queue"] = SendQueue(app_.bot, claim=claim_events)
+        app_.bot_data["send_queue"].start()
+        SEND_QUEUE_DEPTH.set_function(app_.bot_data["send_queue"].depth)
+        WEATHER_CACHE_HITS.set_function(lambda: WEATHER_CACHE.hits)
+        WEATHER_CACHE_MISSES.set_function(lambda: WEATHER_CACHE.misses)
+        USER_CACHE_HITS.set_function(lambda: USER_CACHE.hits)
+        USER_CACHE_MISSES.set_function(lambda: USER_CACHE.misses)
+        OWM_CIRCUIT_OPEN.set_function(lambda: int(OWM_BREAKER.is_open))
+        DATE_FAST_HITS.set_function(lambda: FAST_PATH_STATS["hit"])
+        DATE_FAST_MISSES.set_function(lambda: FAST_PATH_STATS["miss"])
+        PARSER_REJECTED.set_function(lambda: POOL_STATS["rejected"])
+        PARSER_TIMEOUTS.set_function(lambda: POOL_STATS["timeout"])
+        if METRICS_PORT:
+            app_.bot_data["metrics_server"] = await start_metrics_server(METRICS_HOST, METRICS_PORT)
+        start_parser_pool()
+        for tz_name in await list_timezones():
+            await schedule_timezone_job(app_.job_queue, tz_name)
+        if SHARD_COUNT:
+            # The first lease claim catches up on the shards it gains (if CATCHUP_ON_START).
+            app_.job_queue.run_repeating(shard_lease_callback, interval=LEASE_RENEW, first=0, name="shard-lease")
+        elif CATCHUP_ON_START:
+            app_.job_queue.run_once(catch_up_callback, when=0, name="catch-up")
+        if ARCHIVE_AFTER_DAYS > 0:
+            app_.job_queue.run_repeating(archive_callback, interval=ARCHIVE_INTERVAL, first=60, name="archive")
+        log_boot_stats("Ready to serve updates")
+        if WARMUP_ON_START:
+            asyncio.get_running_loop().run_in_executor(None, warm_up)
     app.post_init = _post_init
 
-    print("Bot is running (polling). Press Ctrl+C to stop.")
-    app.run_polling()
+    # Drain queued messages while the bot can still send them
+    async def _post_stop(app_):
+        queue = app_.bot_data.pop("send_queue", None)
+        if queue is not None:
+            # Sends cut off after their claim go back to pending for the next catch-up.
+            held = [i for _, _, claimed in await queue.stop() for i in claimed]
+            if held:
+                log.info("Released %d event(s) whose message was never sent", await release_events(held))
+        if SHARD_COUNT:
+            await release_shards(WORKER_ID)
+    app.post_stop = _post_stop
+
+    async def _post_shutdown(app_):
+        metrics_server = app_.bot_data.pop("metrics_server", None)
+        if metrics_server is not None:
+            await metrics_server.cleanup()
+        OWM_BREAKER.stop()
+        session = app_.bot_data.pop("owm_session", None)
+        if session is not None:
+            await session.close()
+        stop_parser_pool()
+        close_db()
+    app.post_shutdown = _post_shutdown
+    return app
+
+async def run_worker(app: Application):
+    # Same lifecycle as run_polling, minus fetching updates: only the job queue runs.
+    stop = asyncio.Event()
+    try:
+        import signal
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stop.set)
+    except (ImportError, NotImplementedError):  # Windows
+        pass
+    await app.initialize()
+    await app.post_init(app)
+    await app.start()
+    try:
+        await stop.wait()
+    finally:
+        await app.stop()
+        await app.post_stop(app)
+        await app.shutdown()
+        await app.post_shutdown(app)
+
+def main():
+    token = ensure_env("TELEGRAM_BOT_TOKEN")
+    # OWM_API_KEY is checked lazily inside handlers/weather path
+
+    init_db()
+
+    app = build_application(token)
+    if BOT_MODE == "webhook":
+        if not WEBHOOK_URL:
+            raise SystemExit("Please set WEBHOOK_URL environment variable for webhook mode.")
+        url_path = WEBHOOK_PATH or urlsplit(WEBHOOK_URL).path.strip("/")
+        print(f"Bot is running (webhook on {WEBHOOK_LISTEN}:{WEBHOOK_PORT}/{url_path}). Press Ctrl+C to stop.")
+        app.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=url_path,
+            webhook_url=WEBHOOK_URL,
+            secret_token=WEBHOOK_SECRET or None,
+        )
+    elif BOT_MODE == "worker":
+        if not SHARD_COUNT:
+            raise SystemExit("Please set SHARD_COUNT environment variable for worker mode.")
+        print(f"Bot is running (dispatch worker {WORKER_ID}). Press Ctrl+C to stop.")
+        try:
+            asyncio.run(run_worker(app))
+        except KeyboardInterrupt:
+            pass
+    else:
+        print("Bot is running (polling). Press Ctrl+C to stop.")
+        app.run_polling()
 
 if __name__ == "__main__":
     main()
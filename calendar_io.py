@@ -0,0 +1,150 @@
+import csv
+import io
+import re
+from datetime import date, datetime, timezone
+from typing import Iterable, Iterator
+
+from parsing import DATE_RE, untitled
+from tztools import get_zone, local_date
+
+ISO_DATE_RE = re.compile(r"(\d{4})-(\d{1,2})-(\d{1,2})")
+ICS_DATE_RE = re.compile(r"(\d{4})(\d{2})(\d{2})(?:T(\d{2})(\d{2})(\d{2})(Z)?)?")
+
+# ---------- reading ----------
+def _lines(data: bytes) -> Iterator[str]:
+    # Decodes line by line (BOM tolerated) instead of building one big string.
+    return io.TextIOWrapper(io.BytesIO(data), encoding="utf-8-sig", errors="replace", newline="")
+
+def csv_rows(data: bytes) -> Iterator[tuple[int, str, str]]:
+    """(line, title, date text) per CSV record: `title,date`, or any column order with a header
+    naming `title`/`summary` and `date`."""
+    title_col, date_col = 0, 1
+    first = True
+    for i, row in enumerate(csv.reader(_lines(data)), start=1):
+        if not row or not any(c.strip() for c in row):
+            continue
+        if first:
+            # The header, if any, is the first non-empty row
+            first = False
+            header = [c.strip().lower() for c in row]
+            if "date" in header:
+                date_col = header.index("date")
+                title_col = next((header.index(k) for k in ("title", "summary", "name") if k in header),
+                                 next((j for j in range(len(header)) if j != date_col), None))
+                continue
+        title = row[title_col].strip() if title_col is not None and title_col < len(row) else ""
+        yield i, title, (row[date_col].strip() if date_col < len(row) else "")
+
+def _ics_unescape(text: str) -> str:
+    return (text.replace("\\n", " ").replace("\\N", " ")
+            .replace("\\,", ",").replace("\\;", ";").replace("\\\\", "\\"))
+
+def _unfold(lines: Iterable[str]) -> Iterator[tuple[int, str]]:
+    # RFC 5545 folding: a line starting with a space or tab continues the previous one.
+    current, start = None, 0
+    for i, line in enumerate(lines, start=1):
+        line = line.rstrip("\r\n")
+        if line[:1] in (" ", "\t") and current is not None:
+            current += line[1:]
+            continue
+        if current is not None:
+            yield start, current
+        current, start = line, i
+    if current is not None:
+        yield start, current
+
+def ics_rows(data: bytes) -> Iterator[tuple[int, str, str]]:
+    """(line, title, DTSTART property) per VEVENT."""
+    in_event, depth, start, title, dtstart = False, 0, 0, "", ""
+    for i, line in _unfold(_lines(data)):
+        name, _, value = line.partition(":")
+        key = name.split(";", 1)[0].upper()
+        if not in_event:
+            if key == "BEGIN" and value.strip().upper() == "VEVENT":
+                in_event, depth, start, title, dtstart = True, 0, i, "", ""
+        elif key == "BEGIN":
+            depth += 1  # nested component (VALARM...): its SUMMARY isn't the event's
+        elif key == "END":
+            if depth:
+                depth -= 1
+            else:
+                in_event = False
+                yield start, title, dtstart
+        elif depth:
+            continue
+        elif key == "SUMMARY":
+            title = _ics_unescape(value).strip()
+        elif key == "DTSTART":
+            dtstart = line
+
+def parse_date(text: str, tz_name: str) -> date | None:
+    # dd.mm.yyyy (and - or / separators), yyyy-mm-dd, or an iCalendar DTSTART line.
+    try:
+        m = DATE_RE.fullmatch(text)
+        if m:
+            day, month, year = map(int, m.groups())
+            return date(year, month, day)
+        m = ISO_DATE_RE.fullmatch(text)
+        if m:
+            return date(*map(int, m.groups()))
+        if text.upper().startswith("DTSTART"):
+            m = ICS_DATE_RE.fullmatch(text.rpartition(":")[2].strip())
+            if not m:
+                return None
+            y, mo, d, hh, mi, ss, utc = m.groups()
+            if utc:
+                # UTC timestamps land on the user's local day
+                instant = datetime(int(y), int(mo), int(d), int(hh), int(mi), int(ss), tzinfo=timezone.utc)
+                return instant.astimezone(get_zone(tz_name)).date()
+            return date(int(y), int(mo), int(d))
+    except ValueError:
+        return None
+    return None
+
+def read_events(data: bytes, filename: str, tz_name: str, lang: str, limit: int):
+    """Validate an uploaded calendar row by row.
+
+    Returns ([(title, date)], [(line, reason i18n key)]). Rows dated before today in
+    `tz_name` are rejected like /addevent does; anything past `limit` events is dropped.
+    """
+    is_ics = filename.lower().endswith((".ics", ".ical")) or data.lstrip()[:15].upper() == b"BEGIN:VCALENDAR"
+    rows = ics_rows(data) if is_ics else csv_rows(data)
+    today = local_date(tz_name)
+    events, errors = [], []
+    for line, title, date_text in rows:
+        d = parse_date(date_text, tz_name)
+        if d is None:
+            errors.append((line, "import_bad_date"))
+        elif d < today:
+            errors.append((line, "import_past"))
+        elif len(events) >= limit:
+            errors.append((line, "import_too_many"))
+            break
+        else:
+            events.append((title[:200] or untitled(lang), d))
+    return events, errors
+
+# ---------- writing ----------
+ICS_HEADER = "BEGIN:VCALENDAR\r\nVERSION:2.0\r\nPRODID:-//weather-event-bot//EN\r\n"
+ICS_FOOTER = "END:VCALENDAR\r\n"
+CSV_HEADER = "title,date,status,id\r\n"
+
+def _ics_escape(text: str) -> str:
+    return text.replace("\\", "\\\\").replace(";", "\\;").replace(",", "\\,").replace("\n", "\\n")
+
+def ics_event(row, stamp: str) -> str:
+    return (f"BEGIN:VEVENT\r\nUID:event-{row['id']}@weather-event-bot\r\nDTSTAMP:{stamp}\r\n"
+            f"DTSTART;VALUE=DATE:{row['event_date'].replace('-', '')}\r\n"
+            f"SUMMARY:{_ics_escape(row['title'])}\r\nEND:VEVENT\r\n")
+
+def csv_writer():
+    # Returns row -> CSV line; one small buffer reused for every row.
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+
+    def line(row) -> str:
+        buf.seek(0)
+        buf.truncate()
+        writer.writerow((row["title"], row["event_date"], "sent" if row["notified"] else "pending", row["id"]))
+        return buf.getvalue()
+    return line
@@ -1,16 +1,227 @@
 import os
+import atexit
+import json
 import logging
+import queue
+import random
+import socket
+import threading
+import time
+from logging.handlers import QueueHandler, QueueListener
+
+def env_int(name: str, default: int) -> int:
+    val = os.getenv(name)
+    return int(val) if val else default
+
+def env_float(name: str, default: float) -> float:
+    val = os.getenv(name)
+    return float(val) if val else default
+
+def env_bool(name: str, default: bool) -> bool:
+    val = os.getenv(name)
+    return val.strip().lower() in ("1", "true", "yes", "on") if val else default
 
 # ---------- logging ----------
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s | %(levelname)s | %(name)s | %(message)s",
-)
-logging.getLogger("telegram").setLevel(logging.DEBUG)
-logging.getLogger("telegram.ext").setLevel(logging.DEBUG)
+# Records are queued as-is and formatted and written by a listener thread, so a log call on
+# the event loop costs little more than a queue put. The per-command "HIT /..." lines and the
+# full update dumps go through their own loggers and can be rate-limited / sampled.
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+TELEGRAM_LOG_LEVEL = os.getenv("TELEGRAM_LOG_LEVEL", "INFO").upper()   # telegram / telegram.ext
+LOG_JSON = env_bool("LOG_JSON", False)                        # one JSON object per line
+LOG_HIT_RATE = env_float("LOG_HIT_RATE", 20.0)                # "HIT /command" lines per second; 0 = off
+LOG_UPDATE_SAMPLE = env_float("LOG_UPDATE_SAMPLE", 0.0)       # share of raw updates dumped, 0..1
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+class RateLimitFilter(logging.Filter):
+    """Passes at most `rate` records per second (bursts up to one second's worth, and
+    never less than one record, so rates below 1/s still let a line through now and then).
+
+    The next record let through after a quiet spell notes how many were dropped.
+    """
+
+    def __init__(self, rate: float):
+        super().__init__()
+        self.rate = rate
+        self._burst = max(1.0, rate)
+        self._tokens = self._burst
+        self._stamp = time.monotonic()
+        self._dropped = 0
+        self._lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self._burst, self._tokens + (now - self._stamp) * self.rate)
+            self._stamp = now
+            if self._tokens < 1:
+                self._dropped += 1
+                return False
+            self._tokens -= 1
+            dropped, self._dropped = self._dropped, 0
+        if dropped:
+            record.msg = f"{record.msg} [+{dropped} suppressed]"
+        return True
+
+class SampleFilter(logging.Filter):
+    def __init__(self, ratio: float):
+        super().__init__()
+        self.ratio = ratio
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        return random.random() < self.ratio
+
+class _DeferredQueueHandler(QueueHandler):
+    # The stock prepare() formats the message on the calling thread; leave that to the
+    # listener. Fine here because log arguments are not mutated after the call.
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+def _setup_logging() -> QueueListener:
+    output = logging.StreamHandler()
+    output.setFormatter(JsonFormatter() if LOG_JSON else
+                        logging.Formatter("%(asctime)s | %(levelname)s | %(name)s | %(message)s"))
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    root = logging.getLogger()
+    root.handlers[:] = [_DeferredQueueHandler(log_queue)]
+    root.setLevel(LOG_LEVEL)
+    logging.getLogger("telegram").setLevel(TELEGRAM_LOG_LEVEL)
+    logging.getLogger("telegram.ext").setLevel(TELEGRAM_LOG_LEVEL)
+    listener = QueueListener(log_queue, output)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+LOG_LISTENER = _setup_logging()
 log = logging.getLogger("weather-event-bot")
 
-DB_PATH = "bot.db"
+hit_log = logging.getLogger("weather-event-bot.hits")
+if LOG_HIT_RATE > 0:
+    hit_log.addFilter(RateLimitFilter(LOG_HIT_RATE))
+else:
+    hit_log.disabled = True
+
+update_log = logging.getLogger("weather-event-bot.updates")
+if LOG_UPDATE_SAMPLE > 0:
+    update_log.setLevel(logging.DEBUG)
+    update_log.addFilter(SampleFilter(LOG_UPDATE_SAMPLE))
+else:
+    update_log.disabled = True
+
+DB_PATH = os.getenv("DB_PATH", "bot.db")
+
+# Upstream endpoints; override to point at a self-hosted Bot API server or local stand-ins.
+TELEGRAM_BASE_URL = os.getenv("TELEGRAM_BASE_URL", "").rstrip("/")   # e.g. http://127.0.0.1:8081
+OWM_BASE_URL = os.getenv("OWM_BASE_URL", "https://api.openweathermap.org").rstrip("/")
+
+# ---------- tuning ----------
+# How updates arrive: "polling" (default), "webhook" (HTTP listener, usually behind a reverse
+# proxy) or "worker" (no updates at all; only takes part in the sharded daily dispatch).
+BOT_MODE = os.getenv("BOT_MODE", "polling").strip().lower()
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")                    # public URL Telegram posts to
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "127.0.0.1")
+WEBHOOK_PORT = env_int("WEBHOOK_PORT", 8443)
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "")                  # default: the path of WEBHOOK_URL
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")              # checked against Telegram's secret header
+# Updates handled at once (different users in parallel, each user's in order); 1 = sequential.
+CONCURRENT_UPDATES = env_int("CONCURRENT_UPDATES", 1)
+
+# Sharded daily dispatch: users are split into SHARD_COUNT shards (user_id % SHARD_COUNT) and
+# every process sharing the database leases a fair share of them. 0 = off, one process does all.
+SHARD_COUNT = env_int("SHARD_COUNT", 0)
+WORKER_ID = os.getenv("WORKER_ID") or f"{socket.gethostname()}:{os.getpid()}"
+LEASE_TTL = env_float("LEASE_TTL", 30.0)                      # seconds a lease lasts without renewal
+LEASE_RENEW = env_float("LEASE_RENEW", 10.0)                  # seconds between renewals
+
+# Prometheus-format metrics at http://METRICS_HOST:METRICS_PORT/metrics; 0 = disabled.
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = env_int("METRICS_PORT", 0)
+
+# Heavy libraries (dateparser, timezonefinder) load lazily; optionally warm them after boot.
+WARMUP_ON_START = env_bool("WARMUP_ON_START", True)
+
+# Natural-language dates are parsed by dateparser in a pool of worker processes.
+PARSER_WORKERS = env_int("PARSER_WORKERS", 2)                 # worker processes
+PARSER_QUEUE = env_int("PARSER_QUEUE", 32)                    # requests allowed to wait for a worker
+PARSER_TIMEOUT = env_float("PARSER_TIMEOUT", 5.0)             # seconds per parse
+
+# Coordinate -> timezone lookups are memoized per grid cell.
+TZ_LOOKUP_GRID = env_float("TZ_LOOKUP_GRID", 0.01)            # degrees per cell (~1 km)
+TZ_LOOKUP_CACHE_SIZE = env_int("TZ_LOOKUP_CACHE_SIZE", 4096)  # cells kept (LRU)
+
+# SQLite: long-lived connections, a read pool and one serialized writer thread.
+DB_READERS = env_int("DB_READERS", 4)                         # reader threads
+DB_BUSY_TIMEOUT = env_float("DB_BUSY_TIMEOUT", 10.0)          # seconds to wait on a locked DB
+DB_CACHE_KB = env_int("DB_CACHE_KB", 16384)                   # page cache per connection
+
+# Current-weather cache, shared by the daily runs and /checktoday.
+WEATHER_CACHE_TTL = env_float("WEATHER_CACHE_TTL", 600.0)     # seconds
+WEATHER_CACHE_SIZE = env_int("WEATHER_CACHE_SIZE", 10000)     # grid cells
+WEATHER_CACHE_GRID = env_float("WEATHER_CACHE_GRID", 0.1)     # degrees per cell (~11 km)
+
+# Weather for locations with events due is fetched this long before each zone's 08:00 run,
+# at most PREFETCH_RATE requests per second, so the send itself needs no OWM call. 0 = off.
+PREFETCH_LEAD = env_float("PREFETCH_LEAD", 900.0)             # seconds
+PREFETCH_RATE = env_float("PREFETCH_RATE", 5.0)               # OWM requests per second
+
+# Shared OpenWeatherMap HTTP session (one per Application).
+OWM_POOL_LIMIT = env_int("OWM_POOL_LIMIT", 100)               # total connections
+OWM_POOL_PER_HOST = env_int("OWM_POOL_PER_HOST", 50)          # connections per host
+OWM_DNS_CACHE_TTL = env_int("OWM_DNS_CACHE_TTL", 300)         # seconds
+OWM_KEEPALIVE = env_float("OWM_KEEPALIVE", 30.0)              # idle keep-alive, seconds
+OWM_TIMEOUT = env_float("OWM_TIMEOUT", 20.0)                  # whole request, seconds
+OWM_CONNECT_TIMEOUT = env_float("OWM_CONNECT_TIMEOUT", 5.0)   # connect incl. pool wait, seconds
+
+# Circuit breaker on weather requests: after OWM_BREAKER_FAILURES failures in a row, lookups
+# fail fast and a background probe retries every cooldown (doubling up to the max) until one succeeds.
+OWM_BREAKER_FAILURES = env_int("OWM_BREAKER_FAILURES", 5)
+OWM_BREAKER_COOLDOWN = env_float("OWM_BREAKER_COOLDOWN", 30.0)          # seconds
+OWM_BREAKER_MAX_COOLDOWN = env_float("OWM_BREAKER_MAX_COOLDOWN", 300.0)  # seconds
+
+# Outbound Telegram messages from the daily runs.
+SEND_RATE = env_float("SEND_RATE", 30.0)                      # messages per second, whole bot
+SEND_BURST = env_int("SEND_BURST", 30)                        # messages allowed back-to-back
+SEND_CHAT_INTERVAL = env_float("SEND_CHAT_INTERVAL", 1.0)     # seconds between messages to one chat
+SEND_WORKERS = env_int("SEND_WORKERS", 16)                    # concurrent in-flight sends
+SEND_MAX_RETRIES = env_int("SEND_MAX_RETRIES", 3)             # retries after flood control
+DAILY_DIGEST = env_bool("DAILY_DIGEST", False)                # one message per user instead of per event
+
+# Startup catch-up of mornings missed while the bot was down.
+CATCHUP_ON_START = env_bool("CATCHUP_ON_START", True)
+CATCHUP_WORKERS = env_int("CATCHUP_WORKERS", 8)               # users handled at once
+CATCHUP_LOG_EVERY = env_float("CATCHUP_LOG_EVERY", 10.0)      # seconds between progress lines
+
+# In-process cache of user profiles; /setcity and /language update it as they write.
+USER_CACHE_SIZE = env_int("USER_CACHE_SIZE", 10000)           # users
+USER_CACHE_TTL = env_float("USER_CACHE_TTL", 300.0)           # seconds; bounds staleness across processes
+
+# /myevents shows this many events per page, with Prev/Next buttons.
+MYEVENTS_PAGE_SIZE = env_int("MYEVENTS_PAGE_SIZE", 20)
+
+# Notified events older than ARCHIVE_AFTER_DAYS move to events_archive, ARCHIVE_BATCH rows
+# per transaction, every ARCHIVE_INTERVAL seconds; freed pages are released a little at a time.
+ARCHIVE_AFTER_DAYS = env_int("ARCHIVE_AFTER_DAYS", 30)        # 0 = never archive
+ARCHIVE_BATCH = env_int("ARCHIVE_BATCH", 500)
+ARCHIVE_INTERVAL = env_float("ARCHIVE_INTERVAL", 3600.0)      # seconds
+ARCHIVE_VACUUM_PAGES = env_int("ARCHIVE_VACUUM_PAGES", 1000)  # pages freed per run
+
+# /import and /export
+IMPORT_MAX_BYTES = env_int("IMPORT_MAX_BYTES", 2_000_000)     # largest accepted upload
+IMPORT_MAX_EVENTS = env_int("IMPORT_MAX_EVENTS", 10000)       # events per upload
+EXPORT_SPOOL_BYTES = env_int("EXPORT_SPOOL_BYTES", 1_000_000) # bigger exports are buffered on disk
+
+# /setcity lookups (city -> name, lat, lon, timezone) persisted in the DB; 0 = never expire.
+GEO_CACHE_TTL_DAYS = env_float("GEO_CACHE_TTL_DAYS", 0.0)
 
 # ---------- i18n ----------
 LANG_EN = "en"
@@ -28,6 +239,8 @@ I18N = {
                "• /addevent <title> <dd.mm.yyyy or natural text>\n"
                "• /myevents — list your events\n"
                "• /delete <id> — delete an event\n"
+               "• /import — add events from a CSV or .ics file (send it with this caption)\n"
+               "• /export [csv|ics] — download your events\n"
                "• /checktoday — run today’s check for you now\n"
                "• /language — change language"),
         "ru": ("Привет! Я напомню о событиях и расскажу погоду в этот день 🌤\n\n"
@@ -39,6 +252,8 @@ I18N = {
                "• /addevent <название> <дд.мм.гггг или фраза>\n"
                "• /myevents — список событий\n"
                "• /delete <id> — удалить событие\n"
+               "• /import — добавить события из CSV или .ics (отправьте файл с этой подписью)\n"
+               "• /export [csv|ics] — выгрузить события\n"
                "• /checktoday — проверить события на сегодня\n"
                "• /language — сменить язык")
     },
@@ -68,6 +283,16 @@ I18N = {
                   "ru": "Событий пока нет. Добавьте с помощью /addevent …"},
     "myevents_line": {"en": "{mark} {idx}. {title} — {date}  (id {id})",
                       "ru": "{mark} {idx}. {title} — {date}  (id {id})"},
+    "events_prev": {"en": "« Prev", "ru": "« Назад"},
+    "events_next": {"en": "Next »", "ru": "Далее »"},
+    "import_usage": {"en": "Send a CSV (title,date) or .ics file with the caption /import, or reply /import to one.",
+                     "ru": "Отправьте CSV (название,дата) или .ics файл с подписью /import или ответьте /import на него."},
+    "import_too_big": {"en": "That file is too large to import.", "ru": "Файл слишком большой для импорта."},
+    "import_done": {"en": "Imported {n} event(s), skipped {skipped}.", "ru": "Импортировано событий: {n}, пропущено: {skipped}."},
+    "import_error_line": {"en": "• line {line}: {reason}", "ru": "• строка {line}: {reason}"},
+    "import_bad_date": {"en": "unrecognised date", "ru": "дата не распознана"},
+    "import_past": {"en": "date is in the past", "ru": "дата уже прошла"},
+    "import_too_many": {"en": "too many events, the rest were skipped", "ru": "слишком много событий, остальные пропущены"},
     "delete_usage": {"en": "Usage: /delete <event_id>", "ru": "Использование: /delete <id>"},
     "delete_ok": {"en": "Deleted.", "ru": "Удалено."},
     "delete_fail": {"en": "Couldn’t delete (wrong ID?).", "ru": "Не удалось удалить (неверный ID?)."},
@@ -75,6 +300,8 @@ I18N = {
                                  "ru": "Сначала укажите город: /setcity <город>."},
     "checktoday_done": {"en": "Checked today for you.", "ru": "Проверка на сегодня выполнена."},
     "today_you_have": {"en": "Today you have **{title}**.", "ru": "Сегодня у вас **{title}**."},
+    "today_you_have_list": {"en": "Today you have:", "ru": "Сегодня у вас:"},
+    "today_item": {"en": "• **{title}**", "ru": "• **{title}**"},
     "weather_unavailable": {"en": "(Weather unavailable right now.)", "ru": "(Погода сейчас недоступна.)"},
     "advice_default": {"en": "enjoy your day 🙂", "ru": "хорошего дня 🙂"},
     "advice_umbrella": {"en": "take an umbrella ☔️", "ru": "возьмите зонт ☔️"},
@@ -100,9 +327,11 @@ I18N = {
     "w_snow": {"en": "• Snow (last hour): {mm} mm", "ru": "• Снег (за час): {mm} мм"},
 }
 
+# Flattened once at import so t() is a single dict lookup (plus format() when it has fields).
+TEMPLATES = {(key, lang): text for key, by_lang in I18N.items() for lang, text in by_lang.items()}
+
 def t(lang: str, key: str, **kwargs) -> str:
-    lang = lang if lang in (LANG_EN, LANG_RU) else LANG_EN
-    s = I18N[key][lang]
+    s = TEMPLATES[key, lang if lang in (LANG_EN, LANG_RU) else LANG_EN]
     return s.format(**kwargs) if kwargs else s
 
 PICK_LANG_BUTTONS = I18N["pick_lang_buttons"]["en"]
@@ -1,19 +1,95 @@
+import asyncio
+import functools
 import sqlite3
-from datetime import datetime, date
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, date, timedelta
 from typing import Optional, Iterable
-from config import DB_PATH
+from config import DB_PATH, DB_READERS, DB_BUSY_TIMEOUT, DB_CACHE_KB, USER_CACHE_SIZE, USER_CACHE_TTL
+from metrics import DB_SECONDS
+
+_local = threading.local()
+_read_pool = ThreadPoolExecutor(max_workers=DB_READERS, thread_name_prefix="db-read")
+_write_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-write")
 
 def db() -> sqlite3.Connection:
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
+    # One long-lived connection per thread; writes only ever run on the single writer thread.
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(DB_PATH, timeout=DB_BUSY_TIMEOUT)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(f"PRAGMA cache_size=-{DB_CACHE_KB}")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        _local.conn = conn
     return conn
 
+# name -> [calls, seconds spent executing] for every @reader/@writer query
+QUERY_STATS: dict[str, list] = {}
+_stats_lock = threading.Lock()
+
+def _timed(fn):
+    def run(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - start
+            DB_SECONDS.observe(elapsed, query=fn.__name__)
+            with _stats_lock:
+                stat = QUERY_STATS.setdefault(fn.__name__, [0, 0.0])
+                stat[0] += 1
+                stat[1] += elapsed
+    return run
+
+def _run_in(pool: ThreadPoolExecutor):
+    # Turns a blocking query into an awaitable that runs off the event loop.
+    def deco(fn):
+        timed = _timed(fn)
+
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(pool, functools.partial(timed, *args, **kwargs))
+        return wrapper
+    return deco
+
+reader = _run_in(_read_pool)
+writer = _run_in(_write_pool)
+
+def close_db():
+    _write_pool.shutdown(wait=True)
+    _read_pool.shutdown(wait=True)
+
 def column_exists(conn: sqlite3.Connection, table: str, column: str) -> bool:
     cur = conn.execute(f"PRAGMA table_info({table})")
     return any(r[1] == column for r in cur.fetchall())
 
+def index_exists(conn: sqlite3.Connection, name: str) -> bool:
+    cur = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = ?", (name,))
+    return cur.fetchone() is not None
+
+INDEXES = {
+    # list_events_page: a user's events by (date, id), answered from the index alone
+    "idx_events_user_date": "CREATE INDEX idx_events_user_date ON events (user_id, event_date, id, title, notified)",
+    # get_events_for_date: only the still-pending rows are indexed
+    "idx_events_pending": "CREATE INDEX idx_events_pending ON events (user_id, event_date) WHERE notified = 0",
+    # archive_events: old notified rows, oldest first
+    "idx_events_done": "CREATE INDEX idx_events_done ON events (event_date) WHERE notified = 1",
+    # list_timezones, and the per-zone user walk in get_due_page (rowid = user_id rides along)
+    "idx_users_timezone": "CREATE INDEX idx_users_timezone ON users (timezone)",
+}
+
 def init_db():
     with db() as conn:
+        if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            # INCREMENTAL lets the archive job hand freed pages back a few at a time;
+            # existing files need one full VACUUM for the setting to take effect.
+            conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            conn.execute("VACUUM")
         conn.execute("""
             CREATE TABLE IF NOT EXISTS users (
                 user_id INTEGER PRIMARY KEY,
@@ -36,13 +112,111 @@ def init_db():
                 FOREIGN KEY (user_id) REFERENCES users(user_id)
             )
         """)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS geo_cache (
+                query TEXT PRIMARY KEY,
+                name TEXT NOT NULL,
+                lat REAL NOT NULL,
+                lon REAL NOT NULL,
+                timezone TEXT NOT NULL,
+                created_at TEXT NOT NULL
+            )
+        """)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS workers (
+                worker_id TEXT PRIMARY KEY,
+                expires_at REAL NOT NULL
+            )
+        """)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS shard_leases (
+                shard INTEGER PRIMARY KEY,
+                owner TEXT NOT NULL,
+                expires_at REAL NOT NULL
+            )
+        """)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS events_archive (
+                id INTEGER PRIMARY KEY,
+                user_id INTEGER NOT NULL,
+                title TEXT NOT NULL,
+                event_date TEXT NOT NULL,
+                notified INTEGER NOT NULL,
+                created_at TEXT NOT NULL,
+                archived_at TEXT NOT NULL
+            )
+        """)
         if not column_exists(conn, "users", "timezone"):
             conn.execute("ALTER TABLE users ADD COLUMN timezone TEXT NOT NULL DEFAULT 'UTC'")
         if not column_exists(conn, "users", "lang"):
             conn.execute("ALTER TABLE users ADD COLUMN lang TEXT NOT NULL DEFAULT 'en'")
+        missing = [name for name in INDEXES if not index_exists(conn, name)]
+        for name in missing:
+            conn.execute(INDEXES[name])
+        if missing:
+            conn.execute("ANALYZE")
         conn.commit()
 
-def set_user_city(user_id: int, city: str, lat: float, lon: float, timezone: str):
+# ---------- user profiles ----------
+USER_FIELDS = ("user_id", "city", "lat", "lon", "timezone", "lang")
+_USER_SQL = f"SELECT {', '.join(USER_FIELDS)} FROM users WHERE user_id = ?"
+
+class UserProfile:
+    """A users row without sqlite3.Row overhead; supports user["lang"] and user.keys()."""
+    __slots__ = USER_FIELDS
+
+    def __init__(self, user_id: int, city: str, lat: float, lon: float, timezone: str, lang: str):
+        self.user_id = user_id
+        self.city = city
+        self.lat = lat
+        self.lon = lon
+        self.timezone = timezone
+        self.lang = lang
+
+    def __getitem__(self, key: str):
+        return getattr(self, key)
+
+    def keys(self) -> tuple:
+        return USER_FIELDS
+
+class UserCache:
+    """LRU of UserProfile by user_id; entries expire after `ttl` seconds. Event-loop use only."""
+
+    def __init__(self, ttl: float, max_size: int):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._data: OrderedDict[int, tuple[float, UserProfile]] = OrderedDict()
+
+    def get(self, user_id: int) -> Optional[UserProfile]:
+        item = self._data.get(user_id)
+        if item is None or item[0] < time.monotonic():
+            if item is not None:
+                del self._data[user_id]
+            self.misses += 1
+            return None
+        self._data.move_to_end(user_id)
+        self.hits += 1
+        return item[1]
+
+    def put(self, user: UserProfile):
+        self._data[user.user_id] = (time.monotonic() + self.ttl, user)
+        self._data.move_to_end(user.user_id)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+USER_CACHE = UserCache(USER_CACHE_TTL, USER_CACHE_SIZE)
+
+def _select_user(conn: sqlite3.Connection, user_id: int) -> Optional[UserProfile]:
+    row = conn.execute(_USER_SQL, (user_id,)).fetchone()
+    return UserProfile(*row) if row else None
+
+@writer
+def _upsert_user_city(user_id: int, city: str, lat: float, lon: float, timezone: str) -> UserProfile:
     with db() as conn:
         conn.execute("""
             INSERT INTO users (user_id, city, lat, lon, timezone, created_at)
@@ -51,8 +225,10 @@ def set_user_city(user_id: int, city: str, lat: float, lon: float, timezone: str
             SET city=excluded.city, lat=excluded.lat, lon=excluded.lon, timezone=excluded.timezone
         """, (user_id, city, lat, lon, timezone, datetime.now().isoformat()))
         conn.commit()
+        return _select_user(conn, user_id)
 
-def set_user_lang(user_id: int, lang: str):
+@writer
+def _upsert_user_lang(user_id: int, lang: str) -> UserProfile:
     with db() as conn:
         conn.execute("""
             INSERT INTO users (user_id, city, lat, lon, timezone, lang, created_at)
@@ -61,15 +237,32 @@ def set_user_lang(user_id: int, lang: str):
             SET lang=excluded.lang
         """, (user_id, lang, datetime.now().isoformat()))
         conn.commit()
+        return _select_user(conn, user_id)
 
-def get_user(user_id: int) -> Optional[sqlite3.Row]:
-    with db() as conn:
-        return conn.execute("SELECT * FROM users WHERE user_id = ?", (user_id,)).fetchone()
+@reader
+def _load_user(user_id: int) -> Optional[UserProfile]:
+    return _select_user(db(), user_id)
+
+async def set_user_city(user_id: int, city: str, lat: float, lon: float, timezone: str):
+    USER_CACHE.put(await _upsert_user_city(user_id, city, lat, lon, timezone))
 
-def list_all_users() -> Iterable[sqlite3.Row]:
+async def set_user_lang(user_id: int, lang: str):
+    USER_CACHE.put(await _upsert_user_lang(user_id, lang))
+
+async def get_user(user_id: int) -> Optional[UserProfile]:
+    user = USER_CACHE.get(user_id)
+    if user is None:
+        user = await _load_user(user_id)
+        if user is not None:
+            USER_CACHE.put(user)
+    return user
+
+@reader
+def list_timezones() -> list[str]:
     with db() as conn:
-        return conn.execute("SELECT user_id, city, lat, lon, timezone, lang FROM users").fetchall()
+        return [r[0] for r in conn.execute("SELECT DISTINCT timezone FROM users").fetchall()]
 
+@writer
 def add_event(user_id: int, title: str, event_date: date) -> int:
     with db() as conn:
         cur = conn.execute("""
@@ -79,21 +272,60 @@ def add_event(user_id: int, title: str, event_date: date) -> int:
         conn.commit()
         return cur.lastrowid
 
-def list_events(user_id: int):
+@reader
+def list_events_page(user_id: int, limit: int, after: Optional[tuple[str, int]] = None,
+                     before: Optional[tuple[str, int]] = None) -> list[sqlite3.Row]:
+    """Up to `limit` + 1 of a user's events in (event_date, id) order.
+
+    `after` / `before` are the (event_date, id) of the last / first row on the page
+    being left, so each page is a range scan on idx_events_user_date however deep it
+    is. The extra row only tells the caller that there is another page that way.
+    """
     with db() as conn:
+        if before is not None:
+            rows = conn.execute("""
+                SELECT id, title, event_date, notified FROM events
+                WHERE user_id = ? AND (event_date, id) < (?, ?)
+                ORDER BY event_date DESC, id DESC LIMIT ?
+            """, (user_id, *before, limit + 1)).fetchall()
+            return rows[::-1]
         return conn.execute("""
-            SELECT id, title, event_date, notified
-            FROM events
-            WHERE user_id = ?
-            ORDER BY event_date ASC
-        """, (user_id,)).fetchall()
+            SELECT id, title, event_date, notified FROM events
+            WHERE user_id = ? AND (event_date, id) > (?, ?)
+            ORDER BY event_date, id LIMIT ?
+        """, (user_id, *(after or ("", 0)), limit + 1)).fetchall()
+
+@writer
+def add_events_many(user_id: int, events: Iterable[tuple[str, date]]) -> int:
+    # One executemany in one transaction, however many events.
+    now = datetime.utcnow().isoformat()
+    with db() as conn:
+        cur = conn.executemany("""
+            INSERT INTO events (user_id, title, event_date, created_at)
+            VALUES (?, ?, ?, ?)
+        """, ((user_id, title, d.isoformat(), now) for title, d in events))
+        conn.commit()
+        return cur.rowcount
+
+async def iter_events(user_id: int, chunk: int = 500):
+    # Every event of a user in date order, read `chunk` rows at a time.
+    after = None
+    while True:
+        rows = await list_events_page(user_id, chunk, after=after)
+        for r in rows[:chunk]:
+            yield r
+        if len(rows) <= chunk:
+            return
+        after = (rows[chunk - 1]["event_date"], rows[chunk - 1]["id"])
 
+@writer
 def delete_event(user_id: int, event_id: int) -> bool:
     with db() as conn:
         cur = conn.execute("DELETE FROM events WHERE id = ? AND user_id = ?", (event_id, user_id))
         conn.commit()
         return cur.rowcount > 0
 
+@reader
 def get_events_for_date(user_id: int, day_iso: str) -> list[sqlite3.Row]:
     with db() as conn:
         return conn.execute("""
@@ -102,7 +334,220 @@ def get_events_for_date(user_id: int, day_iso: str) -> list[sqlite3.Row]:
             WHERE user_id = ? AND event_date = ? AND notified = 0
         """, (user_id, day_iso)).fetchall()
 
-def mark_notified(event_id: int):
+def _due_sql(n_shards: int) -> str:
+    # One zone, the next `limit` users after the cursor that have something due. The user
+    # scan walks idx_users_timezone (timezone, then user_id as rowid) in order, so each page
+    # starts where the last one stopped; only that page's events get sorted.
+    shard_filter = f"AND u.user_id % ? IN ({', '.join(['?'] * n_shards)})" if n_shards else ""
+    return f"""
+        WITH page AS (
+            SELECT u.user_id, u.lat, u.lon, u.timezone, u.lang
+            FROM users u
+            WHERE u.timezone = ? AND u.user_id > ? {shard_filter}
+              AND EXISTS (SELECT 1 FROM events e
+                          WHERE e.user_id = u.user_id AND e.event_date = ? AND e.notified = 0)
+            ORDER BY u.user_id
+            LIMIT ?
+        )
+        SELECT e.id, e.title, e.event_date, p.user_id, p.lat, p.lon, p.timezone, p.lang
+        FROM page p
+        JOIN events e ON e.user_id = p.user_id AND e.event_date = ? AND e.notified = 0
+        ORDER BY p.user_id, e.id
+    """
+
+@reader
+def get_due_page(tz_name: str, day: str, after: int, limit: int,
+                 shards: Optional[list[int]] = None, shard_count: int = 0) -> list[sqlite3.Row]:
+    # Pending events due on `day` for up to `limit` users in `tz_name` with user_id > `after`.
+    # With `shards`, only users whose user_id % shard_count is one of them are returned.
+    params = [tz_name, after]
+    if shards:
+        params += [shard_count, *shards]
+    with db() as conn:
+        return conn.execute(_due_sql(len(shards or ())), (*params, day, limit, day)).fetchall()
+
+@reader
+def list_due_locations(days: dict[str, str], grid: float, shards: Optional[list[int]] = None,
+                       shard_count: int = 0) -> list[tuple[float, float]]:
+    # One (lat, lon) per `grid`-degree cell that has a user with a pending event due on their zone's day.
+    values = ", ".join(["(?, ?)"] * len(days))
+    params = [v for item in days.items() for v in item]
+    shard_filter = ""
+    if shards:
+        shard_filter = f"AND u.user_id % ? IN ({', '.join(['?'] * len(shards))})"
+        params += [shard_count, *shards]
+    with db() as conn:
+        rows = conn.execute(f"""
+            WITH due(timezone, day) AS (VALUES {values})
+            SELECT u.lat, u.lon
+            FROM due
+            JOIN users u ON u.timezone = due.timezone
+            WHERE EXISTS (
+                SELECT 1 FROM events e
+                WHERE e.user_id = u.user_id AND e.event_date = due.day AND e.notified = 0
+            ) {shard_filter}
+            GROUP BY round(u.lat / ?), round(u.lon / ?)
+        """, (*params, grid, grid)).fetchall()
+    return [(r[0], r[1]) for r in rows]
+
+async def stream_due_by_user(days: dict[str, str], shards: Optional[list[int]] = None,
+                             shard_count: int = 0, chunk: int = 500):
+    """Yield, per user, the list of pending events due on their zone's day.
+
+    Each row carries the event (id, title, event_date) and its owner's user_id, lat,
+    lon, timezone and lang. Users without due events never show up. `shards` limits
+    the sweep to users in those shards (user_id % shard_count); None means all users.
+    Zones are swept one after another, `chunk` users per query.
+    """
+    if shards == []:
+        return
+    for tz_name, day in days.items():
+        after = 0
+        while True:
+            rows = await get_due_page(tz_name, day, after, chunk, shards, shard_count)
+            users = 0
+            current: list[sqlite3.Row] = []
+            for r in rows:
+                if current and current[0]["user_id"] != r["user_id"]:
+                    yield current
+                    users += 1
+                    current = []
+                current.append(r)
+            if current:
+                yield current
+                users += 1
+                after = current[0]["user_id"]
+            if users < chunk:
+                break
+
+@writer
+def claim_events(event_ids: Iterable[int]) -> list[int]:
+    # Marks events notified and returns the ids this call flipped; an id another
+    # worker already claimed is left out, so each event is sent at most once.
+    ids = list(event_ids)
+    if not ids:
+        return []
+    with db() as conn:
+        claimed = [r[0] for r in conn.execute(f"""
+            UPDATE events SET notified = 1
+            WHERE notified = 0 AND id IN ({', '.join('?' * len(ids))})
+            RETURNING id
+        """, ids)]
+        conn.commit()
+        return claimed
+
+@writer
+def release_events(event_ids: Iterable[int]) -> int:
+    # Puts claimed events whose message never went out back to pending.
+    ids = list(event_ids)
+    if not ids:
+        return 0
     with db() as conn:
-        conn.execute("UPDATE events SET notified = 1 WHERE id = ?", (event_id,))
+        cur = conn.execute(f"""
+            UPDATE events SET notified = 0
+            WHERE notified = 1 AND id IN ({', '.join('?' * len(ids))})
+        """, ids)
+        conn.commit()
+        return cur.rowcount
+
+# ---------- retention ----------
+@writer
+def archive_events(before_iso: str, batch: int) -> int:
+    # Moves up to `batch` notified events dated before `before_iso` into events_archive.
+    with db() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        ids = [r[0] for r in conn.execute(
+            "SELECT id FROM events WHERE notified = 1 AND event_date < ? ORDER BY event_date LIMIT ?",
+            (before_iso, batch))]
+        if ids:
+            marks = ", ".join("?" * len(ids))
+            conn.execute(f"""
+                INSERT OR IGNORE INTO events_archive (id, user_id, title, event_date, notified, created_at, archived_at)
+                SELECT id, user_id, title, event_date, notified, created_at, ? FROM events WHERE id IN ({marks})
+            """, (datetime.now().isoformat(), *ids))
+            conn.execute(f"DELETE FROM events WHERE id IN ({marks})", ids)
+        conn.commit()
+        return len(ids)
+
+@writer
+def reclaim_space(pages: int) -> int:
+    # Releases up to `pages` free pages back to the filesystem; returns how many were free.
+    conn = db()
+    free = conn.execute("PRAGMA freelist_count").fetchone()[0]
+    conn.execute(f"PRAGMA incremental_vacuum({int(pages)})").fetchall()
+    return min(free, pages)
+
+# ---------- shard leases ----------
+@writer
+def claim_shards(worker_id: str, shard_count: int, ttl: float) -> list[int]:
+    """Heartbeat `worker_id`, renew its leases and return the shards it now owns.
+
+    Each live worker aims for ceil(shard_count / live workers) shards: it gives back
+    any above that (so a newly started worker can pick them up) and takes free or
+    expired ones to make up the difference. Runs as one IMMEDIATE transaction, so
+    processes sharing the database never grab the same shard.
+    """
+    now = time.time()
+    with db() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        conn.execute("""
+            INSERT INTO workers (worker_id, expires_at) VALUES (?, ?)
+            ON CONFLICT(worker_id) DO UPDATE SET expires_at=excluded.expires_at
+        """, (worker_id, now + ttl))
+        conn.execute("DELETE FROM workers WHERE expires_at < ?", (now,))
+        conn.execute("DELETE FROM shard_leases WHERE shard >= ?", (shard_count,))
+        live = conn.execute("SELECT COUNT(*) FROM workers").fetchone()[0]
+        fair = -(-shard_count // live)
+
+        conn.execute("UPDATE shard_leases SET expires_at = ? WHERE owner = ?", (now + ttl, worker_id))
+        own = [r[0] for r in conn.execute(
+            "SELECT shard FROM shard_leases WHERE owner = ? ORDER BY shard", (worker_id,))]
+        if len(own) > fair:
+            conn.executemany("DELETE FROM shard_leases WHERE shard = ?", ((s,) for s in own[fair:]))
+            own = own[:fair]
+        elif len(own) < fair:
+            taken = {r[0] for r in conn.execute("SELECT shard FROM shard_leases WHERE expires_at >= ?", (now,))}
+            free = [s for s in range(shard_count) if s not in taken][:fair - len(own)]
+            conn.executemany("""
+                INSERT INTO shard_leases (shard, owner, expires_at) VALUES (?, ?, ?)
+                ON CONFLICT(shard) DO UPDATE SET owner=excluded.owner, expires_at=excluded.expires_at
+            """, ((s, worker_id, now + ttl) for s in free))
+            own = sorted(own + free)
+        conn.commit()
+        return own
+
+@writer
+def release_shards(worker_id: str):
+    with db() as conn:
+        conn.execute("DELETE FROM shard_leases WHERE owner = ?", (worker_id,))
+        conn.execute("DELETE FROM workers WHERE worker_id = ?", (worker_id,))
+        conn.commit()
+
+def normalize_city_query(query: str) -> str:
+    return " ".join(query.split()).casefold()
+
+@reader
+def get_cached_geo(query: str, max_age_days: float = 0) -> Optional[sqlite3.Row]:
+    with db() as conn:
+        row = conn.execute("""
+            SELECT name, lat, lon, timezone, created_at
+            FROM geo_cache
+            WHERE query = ?
+        """, (normalize_city_query(query),)).fetchone()
+    if row and max_age_days > 0:
+        cutoff = (datetime.utcnow() - timedelta(days=max_age_days)).isoformat()
+        if row["created_at"] < cutoff:
+            return None
+    return row
+
+@writer
+def cache_geo(query: str, name: str, lat: float, lon: float, timezone: str):
+    with db() as conn:
+        conn.execute("""
+            INSERT INTO geo_cache (query, name, lat, lon, timezone, created_at)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT(query) DO UPDATE
+            SET name=excluded.name, lat=excluded.lat, lon=excluded.lon,
+                timezone=excluded.timezone, created_at=excluded.created_at
+        """, (normalize_city_query(query), name, lat, lon, timezone, datetime.utcnow().isoformat()))
         conn.commit()
@@ -1,17 +1,28 @@
+import asyncio
 import os
-from datetime import datetime, time as dt_time
+import tempfile
+import time
+from datetime import datetime, date, time as dt_time, timedelta, timezone
 from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton
 from telegram.ext import ContextTypes, CommandHandler, MessageHandler, CallbackQueryHandler, JobQueue, filters
 
-from config import log, t, LANG_EN, PICK_LANG_BUTTONS
+from config import (
+    log, hit_log, update_log, t, LANG_EN, PICK_LANG_BUTTONS, GEO_CACHE_TTL_DAYS, DAILY_DIGEST,
+    SHARD_COUNT, WORKER_ID, LEASE_TTL, PREFETCH_LEAD, PREFETCH_RATE, WEATHER_CACHE_TTL, WEATHER_CACHE_GRID,
+    MYEVENTS_PAGE_SIZE, ARCHIVE_AFTER_DAYS, ARCHIVE_BATCH, ARCHIVE_VACUUM_PAGES,
+    IMPORT_MAX_BYTES, IMPORT_MAX_EVENTS, EXPORT_SPOOL_BYTES, CATCHUP_ON_START, CATCHUP_WORKERS, CATCHUP_LOG_EVERY
+)
 from db import (
     get_user, set_user_lang, set_user_city,
-    add_event, list_events, delete_event, get_events_for_date, mark_notified,
-    list_all_users
+    add_event, add_events_many, iter_events, list_events_page, delete_event, get_events_for_date,
+    stream_due_by_user, get_cached_geo, cache_geo, list_timezones, claim_shards, list_due_locations,
+    archive_events, reclaim_space
 )
-from tztools import detect_timezone_name, tz_now
-from parsing import parse_event_args
-from weather import geocode_city, fetch_current_weather, make_advice, format_weather_list
+from tztools import detect_timezone_name, get_zone, local_date
+from parsing import parse_event_args_async
+from metrics import timed_command, SCHEDULER_LAG
+from calendar_io import read_events, csv_writer, ics_event, CSV_HEADER, ICS_HEADER, ICS_FOOTER
+from weather import geocode_city, get_weather, prefetch_weather, render_weather
 
 def row_has(row, key: str) -> bool:
     try:
@@ -22,38 +33,48 @@ def row_has(row, key: str) -> bool:
 def user_lang_or_default(user, default="en"):
     return user["lang"] if (user and row_has(user, "lang") and user["lang"]) else default
 
+def owm_session(context: ContextTypes.DEFAULT_TYPE):
+    return context.bot_data["owm_session"]
+
+def send_queue(context: ContextTypes.DEFAULT_TYPE):
+    return context.bot_data["send_queue"]
+
 # ---------- UI helpers ----------
 def lang_keyboard() -> InlineKeyboardMarkup:
     rows = [[InlineKeyboardButton(text=txt, callback_data=data)] for txt, data in PICK_LANG_BUTTONS]
     return InlineKeyboardMarkup(rows)
 
 # ---------- Handlers ----------
+@timed_command("language")
 async def cmd_language(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user = get_user(update.effective_user.id)
+    user = await get_user(update.effective_user.id)
     lang = user_lang_or_default(user, LANG_EN)
     await update.effective_message.reply_text(t(lang, "start_pick_lang"), reply_markup=lang_keyboard())
 
+@timed_command("language_pick")
 async def on_language_pick(update: Update, context: ContextTypes.DEFAULT_TYPE):
     q = update.callback_query
     await q.answer()
     if not q.data.startswith("lang:"):
         return
     new_lang = q.data.split(":", 1)[1]
-    set_user_lang(q.from_user.id, new_lang)
+    await set_user_lang(q.from_user.id, new_lang)
     await q.edit_message_text(t(new_lang, "lang_saved"))
     await context.bot.send_message(chat_id=q.from_user.id, text=t(new_lang, "start_help"))
 
+@timed_command("start")
 async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    log.info("HIT /start: %r", update.effective_message.text)
-    user = get_user(update.effective_user.id)
+    hit_log.info("HIT /start: %r", update.effective_message.text)
+    user = await get_user(update.effective_user.id)
     if not user or not row_has(user, "lang"):
         await update.effective_message.reply_text(t(LANG_EN, "start_pick_lang"), reply_markup=lang_keyboard())
         return
     await update.effective_message.reply_text(t(user["lang"], "start_help"))
 
+@timed_command("setcity")
 async def cmd_setcity(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    log.info("HIT /setcity: %r", update.effective_message.text)
-    user = get_user(update.effective_user.id)
+    hit_log.info("HIT /setcity: %r", update.effective_message.text)
+    user = await get_user(update.effective_user.id)
     lang = user_lang_or_default(user, LANG_EN)
 
     api_key = os.getenv("OWM_API_KEY")
@@ -65,20 +86,25 @@ async def cmd_setcity(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     city_input = " ".join(context.args)
-    async with aiohttp.ClientSession() as session:
-        geo = await geocode_city(session, api_key, city_input)
-    if not geo:
-        await update.effective_message.reply_text(t(lang, "setcity_not_found"))
-        return
+    geo = await get_cached_geo(city_input, GEO_CACHE_TTL_DAYS)
+    if geo:
+        tz_name = geo["timezone"]
+    else:
+        geo = await geocode_city(owm_session(context), api_key, city_input)
+        if not geo:
+            await update.effective_message.reply_text(t(lang, "setcity_not_found"))
+            return
+        tz_name = detect_timezone_name(geo["lat"], geo["lon"])
+        await cache_geo(city_input, geo["name"], geo["lat"], geo["lon"], tz_name)
 
-    tz_name = detect_timezone_name(geo["lat"], geo["lon"])
-    set_user_city(update.effective_user.id, geo["name"], geo["lat"], geo["lon"], tz_name)
+    await set_user_city(update.effective_user.id, geo["name"], geo["lat"], geo["lon"], tz_name)
     await update.effective_message.reply_text(t(lang, "setcity_ok", city=geo["name"], tz=tz_name))
-    await schedule_user_daily_job(context.job_queue, update.effective_user.id, tz_name)
+    await schedule_timezone_job(context.job_queue, tz_name)
 
+@timed_command("addevent")
 async def cmd_addevent(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    log.info("HIT /addevent: %r", update.effective_message.text)
-    user = get_user(update.effective_user.id)
+    hit_log.info("HIT /addevent: %r", update.effective_message.text)
+    user = await get_user(update.effective_user.id)
     lang = user_lang_or_default(user, LANG_EN)
     if not user:
         await update.effective_message.reply_text(t(lang, "addevent_set_city_first"))
@@ -88,108 +114,349 @@ async def cmd_addevent(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.effective_message.reply_text(t(lang, "addevent_usage"))
         return
     args_text = parts[1].strip()
-    parsed = parse_event_args(args_text, user["timezone"], lang)
+    parsed = await parse_event_args_async(args_text, user["timezone"], lang)
     if not parsed:
         await update.effective_message.reply_text(t(lang, "addevent_need_date"))
         return
     title, d = parsed
-    if d < tz_now(user["timezone"]).date():
+    if d < local_date(user["timezone"]):
         await update.effective_message.reply_text(t(lang, "addevent_past"))
         return
-    event_id = add_event(update.effective_user.id, title, d)
+    event_id = await add_event(update.effective_user.id, title, d)
     await update.effective_message.reply_text(t(lang, "addevent_ok", id=event_id, title=title, date=d.strftime('%d.%m.%Y')))
 
+def events_page(rows, lang: str, start: int, has_prev: bool, has_next: bool):
+    # Text and Prev/Next keyboard for one page; buttons carry the keyset cursor.
+    lines = []
+    for idx, r in enumerate(rows, start=start):
+        mark = "✅" if r["notified"] else "⏳"
+        d = r["event_date"]
+        lines.append(t(lang, "myevents_line", mark=mark, idx=idx, title=r["title"],
+                       date=f"{d[8:10]}.{d[5:7]}.{d[:4]}", id=r["id"]))
+    buttons = []
+    if has_prev:
+        first = rows[0]
+        buttons.append(InlineKeyboardButton(t(lang, "events_prev"),
+                                            callback_data=f"ev:p:{start}:{first['event_date']}:{first['id']}"))
+    if has_next:
+        last = rows[-1]
+        buttons.append(InlineKeyboardButton(t(lang, "events_next"),
+                                            callback_data=f"ev:n:{start + len(rows)}:{last['event_date']}:{last['id']}"))
+    return "\n".join(lines), (InlineKeyboardMarkup([buttons]) if buttons else None)
+
+@timed_command("myevents")
 async def cmd_myevents(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    log.info("HIT /myevents: %r", update.effective_message.text)
-    user = get_user(update.effective_user.id)
+    hit_log.info("HIT /myevents: %r", update.effective_message.text)
+    user = await get_user(update.effective_user.id)
     lang = user_lang_or_default(user, LANG_EN)
-    rows = list_events(update.effective_user.id)
+    rows = await list_events_page(update.effective_user.id, MYEVENTS_PAGE_SIZE)
     if not rows:
         await update.effective_message.reply_text(t(lang, "no_events"))
         return
-    lines = []
-    for idx, r in enumerate(rows[:100], start=1):
-        mark = "✅" if r["notified"] else "⏳"
-        dt_text = datetime.strptime(r["event_date"], "%Y-%m-%d").strftime("%d.%m.%Y")
-        lines.append(t(lang, "myevents_line", mark=mark, idx=idx, title=r["title"], date=dt_text, id=r["id"]))
-    await update.effective_message.reply_text("\n".join(lines))
+    text, markup = events_page(rows[:MYEVENTS_PAGE_SIZE], lang, 1, False, len(rows) > MYEVENTS_PAGE_SIZE)
+    await update.effective_message.reply_text(text, reply_markup=markup)
+
+@timed_command("myevents_page")
+async def on_events_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # callback_data: ev:<n|p>:<number of the first row on the new / old page>:<event_date>:<id>
+    q = update.callback_query
+    await q.answer()
+    _, direction, start, day, event_id = q.data.split(":")
+    user = await get_user(q.from_user.id)
+    lang = user_lang_or_default(user, LANG_EN)
+    cursor = (day, int(event_id))
+    size = MYEVENTS_PAGE_SIZE
+    if direction == "n":
+        rows = await list_events_page(q.from_user.id, size, after=cursor)
+        more, rows = len(rows) > size, rows[:size]
+        start, has_prev, has_next = int(start), True, more
+    else:
+        rows = await list_events_page(q.from_user.id, size, before=cursor)
+        more, rows = len(rows) > size, rows[-size:]
+        start, has_prev, has_next = max(1, int(start) - len(rows)), more, True
+    if not rows:
+        await q.edit_message_text(t(lang, "no_events"))
+        return
+    text, markup = events_page(rows, lang, start, has_prev, has_next)
+    await q.edit_message_text(text, reply_markup=markup)
 
+@timed_command("import")
+async def cmd_import(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Works as the caption of an uploaded file or as a reply to one.
+    msg = update.effective_message
+    hit_log.info("HIT /import")
+    user = await get_user(update.effective_user.id)
+    lang = user_lang_or_default(user, LANG_EN)
+    if not user:
+        await msg.reply_text(t(lang, "addevent_set_city_first"))
+        return
+    doc = msg.document or (msg.reply_to_message.document if msg.reply_to_message else None)
+    if doc is None:
+        await msg.reply_text(t(lang, "import_usage"))
+        return
+    if (doc.file_size or 0) > IMPORT_MAX_BYTES:
+        await msg.reply_text(t(lang, "import_too_big"))
+        return
+    data = bytes(await (await doc.get_file()).download_as_bytearray())
+    loop = asyncio.get_running_loop()
+    events, errors = await loop.run_in_executor(
+        None, read_events, data, doc.file_name or "", user["timezone"], lang, IMPORT_MAX_EVENTS)
+    added = await add_events_many(update.effective_user.id, events) if events else 0
+    lines = [t(lang, "import_done", n=added, skipped=len(errors))]
+    lines += [t(lang, "import_error_line", line=line, reason=t(lang, key)) for line, key in errors[:10]]
+    await msg.reply_text("\n".join(lines))
+
+@timed_command("export")
+async def cmd_export(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    hit_log.info("HIT /export: %r", update.effective_message.text)
+    user = await get_user(update.effective_user.id)
+    lang = user_lang_or_default(user, LANG_EN)
+    fmt = "ics" if context.args and context.args[0].lower() in ("ics", "ical") else "csv"
+    # Rows are written out as they are read, so only the file (on disk once large) holds them all.
+    with tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_BYTES) as f:
+        if fmt == "ics":
+            stamp = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+            f.write(ICS_HEADER.encode())
+            render = lambda r: ics_event(r, stamp)
+        else:
+            f.write(CSV_HEADER.encode())
+            render = csv_writer()
+        n = 0
+        async for r in iter_events(update.effective_user.id):
+            f.write(render(r).encode())
+            n += 1
+        if not n:
+            await update.effective_message.reply_text(t(lang, "no_events"))
+            return
+        if fmt == "ics":
+            f.write(ICS_FOOTER.encode())
+        f.seek(0)
+        await update.effective_message.reply_document(document=f, filename=f"events.{fmt}")
+
+@timed_command("delete")
 async def cmd_delete(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    log.info("HIT /delete: %r", update.effective_message.text)
-    user = get_user(update.effective_user.id)
+    hit_log.info("HIT /delete: %r", update.effective_message.text)
+    user = await get_user(update.effective_user.id)
     lang = user_lang_or_default(user, LANG_EN)
     if not context.args or not context.args[0].isdigit():
         await update.effective_message.reply_text(t(lang, "delete_usage"))
         return
-    ok = delete_event(update.effective_user.id, int(context.args[0]))
+    ok = await delete_event(update.effective_user.id, int(context.args[0]))
     await update.effective_message.reply_text(t(lang, "delete_ok") if ok else t(lang, "delete_fail"))
 
+@timed_command("checktoday")
 async def cmd_checktoday(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    log.info("HIT /checktoday: %r", update.effective_message.text)
-    user = get_user(update.effective_user.id)
+    hit_log.info("HIT /checktoday: %r", update.effective_message.text)
+    user = await get_user(update.effective_user.id)
     lang = user_lang_or_default(user, LANG_EN)
     if not user:
         await update.effective_message.reply_text(t(lang, "checktoday_setcity_first"))
         return
-    await run_daily_for_user(context, user)
+    await run_daily_for_user(context, user, wait=True)
     await update.effective_message.reply_text(t(lang, "checktoday_done"))
 
+@timed_command("ping")
 async def cmd_ping(update, context):
     await update.effective_message.reply_text("pong (replied successfully)")
 
 async def debug_echo(update, context):
-    log.debug("Got update: %s", update)
+    update_log.debug("Got update: %s", update)
 
 # ---------- Scheduling ----------
 from telegram.ext import JobQueue
-from zoneinfo import ZoneInfo
-import aiohttp
 
-async def schedule_user_daily_job(job_queue: JobQueue, user_id: int, tz_name: str):
+DAILY_TIME = dt_time(hour=8, minute=0)
+
+PREFETCH_TIME = (datetime.combine(date.min, DAILY_TIME) - timedelta(seconds=PREFETCH_LEAD)).time() \
+    if 0 < PREFETCH_LEAD < 8 * 3600 and PREFETCH_RATE > 0 else None
+
+def timezone_job_name(tz_name: str) -> str:
+    return f"daily-tz-{tz_name}"
+
+async def schedule_timezone_job(job_queue: JobQueue, tz_name: str):
+    # One job per timezone: every user in that zone is handled by the same 08:00 run.
     if job_queue is None:
         log.error('JobQueue not available. Install: pip install "python-telegram-bot[job-queue]"')
         return
-    name = f"daily-{user_id}"
-    for job in job_queue.get_jobs_by_name(name):
-        job.schedule_removal()
+    name = timezone_job_name(tz_name)
+    if job_queue.get_jobs_by_name(name):
+        return
     job_queue.run_daily(
-        callback=user_daily_job_callback,
-        time=dt_time(hour=8, minute=0, tzinfo=ZoneInfo(tz_name)),
+        callback=timezone_job_callback,
+        time=DAILY_TIME.replace(tzinfo=get_zone(tz_name)),
         name=name,
-        data={"user_id": user_id},
+        data={"timezone": tz_name},
     )
-    log.info("Scheduled daily job for user %s at 08:00 %s", user_id, tz_name)
+    if PREFETCH_TIME is not None:
+        job_queue.run_daily(
+            callback=prefetch_job_callback,
+            time=PREFETCH_TIME.replace(tzinfo=get_zone(tz_name)),
+            name=f"prefetch-{name}",
+            data={"timezone": tz_name},
+        )
+    log.info("Scheduled daily job for timezone %s at 08:00", tz_name)
 
-async def user_daily_job_callback(context: ContextTypes.DEFAULT_TYPE):
-    user_id = context.job.data["user_id"]
-    user = get_user(user_id)
-    if not user:
+async def prefetch_job_callback(context: ContextTypes.DEFAULT_TYPE):
+    tz_name = context.job.data["timezone"]
+    owm_key = os.getenv("OWM_API_KEY")
+    shards = owned_shards(context)
+    if not owm_key or shards == []:
+        return
+    day = local_date(tz_name).isoformat()
+    locations = await list_due_locations({tz_name: day}, WEATHER_CACHE_GRID, shards, SHARD_COUNT)
+    if not locations:
+        return
+    if len(locations) / PREFETCH_RATE > PREFETCH_LEAD:
+        log.warning("Prefetch for %s: %d locations won't all finish before 08:00 at %.1f/s",
+                    tz_name, len(locations), PREFETCH_RATE)
+    # Keep snapshots until well after the send; expired or missing ones are fetched live.
+    stored = await prefetch_weather(owm_session(context), owm_key, locations, PREFETCH_RATE,
+                                    ttl=PREFETCH_LEAD + WEATHER_CACHE_TTL)
+    log.info("Prefetched weather for %s: %d/%d location(s)", tz_name, stored, len(locations))
+
+async def timezone_job_callback(context: ContextTypes.DEFAULT_TYPE):
+    tz_name = context.job.data["timezone"]
+    target = datetime.combine(local_date(tz_name), DAILY_TIME, tzinfo=get_zone(tz_name))
+    SCHEDULER_LAG.observe((datetime.now(get_zone(tz_name)) - target).total_seconds())
+    await dispatch_timezone(context, tz_name)
+
+async def dispatch_timezone(context: ContextTypes.DEFAULT_TYPE, tz_name: str):
+    shards = owned_shards(context)
+    if shards == []:
+        log.info("Daily run for %s skipped: this worker owns no shards", tz_name)
+        return
+    day = local_date(tz_name).isoformat()
+    users = 0
+    async for due in stream_due_by_user({tz_name: day}, shards, SHARD_COUNT):
+        users += 1
+        try:
+            await deliver_due(context, due[0], due)
+        except Exception as ex:
+            log.exception("Daily run failed for user %s: %s", due[0]["user_id"], ex)
+    log.info("Daily run for %s: %d user(s) with events", tz_name, users)
+
+async def catch_up(context: ContextTypes.DEFAULT_TYPE, shards=None):
+    """Send today's still-pending events in every timezone whose 08:00 has already passed.
+
+    Users are handed to CATCHUP_WORKERS workers through a short queue; each waits for its
+    messages to go out, so a large backlog drains at the send queue's pace instead of
+    flooding OWM and Telegram at once.
+    """
+    now = datetime.now(timezone.utc)
+    days = {}
+    for tz_name in await list_timezones():
+        local = now.astimezone(get_zone(tz_name))
+        if local.time() >= DAILY_TIME:
+            days[tz_name] = local.date().isoformat()
+    queue: asyncio.Queue = asyncio.Queue(maxsize=CATCHUP_WORKERS * 2)
+    done = failed = 0
+
+    async def worker():
+        nonlocal done, failed
+        while True:
+            due = await queue.get()
+            try:
+                await deliver_due(context, due[0], due, wait=True)
+            except Exception as ex:
+                failed += 1
+                log.exception("Catch-up failed for user %s: %s", due[0]["user_id"], ex)
+            finally:
+                done += 1
+                queue.task_done()
+
+    started = last_log = time.monotonic()
+    workers = [asyncio.create_task(worker(), name=f"catch-up-{i}") for i in range(CATCHUP_WORKERS)]
+    try:
+        async for due in stream_due_by_user(days, shards, SHARD_COUNT):
+            await queue.put(due)
+            if time.monotonic() - last_log >= CATCHUP_LOG_EVERY:
+                last_log = time.monotonic()
+                log.info("Catch-up in progress: %d user(s) done, %d queued", done, queue.qsize())
+        await queue.join()
+    finally:
+        for task in workers:
+            task.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+    if done:
+        log.info("Catch-up sent today's pending events to %d user(s) in %.1fs (%d failed)",
+                 done, time.monotonic() - started, failed)
+
+async def catch_up_callback(context: ContextTypes.DEFAULT_TYPE):
+    data = context.job.data or {}
+    await catch_up(context, data.get("shards", owned_shards(context)))
+
+# ---------- Sharding ----------
+def owned_shards(context: ContextTypes.DEFAULT_TYPE):
+    # None when sharding is off (this process handles every user), else the shards
+    # whose lease is still valid; [] while this worker holds none.
+    if not SHARD_COUNT:
+        return None
+    lease = context.bot_data.get("shard_lease")
+    if not lease or lease["expires"] < time.time():
+        return []
+    return lease["shards"]
+
+async def shard_lease_callback(context: ContextTypes.DEFAULT_TYPE):
+    previous = set(owned_shards(context) or ())
+    first_claim = "shard_lease" not in context.bot_data
+    started = time.time()
+    try:
+        shards = await claim_shards(WORKER_ID, SHARD_COUNT, LEASE_TTL)
+    except Exception as ex:
+        log.exception("Shard lease renewal failed: %s", ex)
+        return
+    context.bot_data["shard_lease"] = {"shards": shards, "expires": started + LEASE_TTL}
+    gained = sorted(set(shards) - previous)
+    if gained or previous - set(shards):
+        log.info("Worker %s now owns shards %s of %d", WORKER_ID, shards, SHARD_COUNT)
+    # Other processes may have added users in new timezones since we last looked.
+    for tz_name in await list_timezones():
+        await schedule_timezone_job(context.job_queue, tz_name)
+    if gained and (CATCHUP_ON_START or not first_claim):
+        # A shard taken over mid-day may have missed its 08:00 run on the previous owner;
+        # the shards of the first claim count as the startup catch-up.
+        # Run as its own job so a long backlog doesn't hold up the next lease renewal.
+        context.job_queue.run_once(catch_up_callback, when=0, name="catch-up", data={"shards": gained})
+
+async def run_daily_for_user(context: ContextTypes.DEFAULT_TYPE, user_row, wait: bool = False):
+    local_today = local_date(user_row["timezone"]).isoformat()
+    due = await get_events_for_date(user_row["user_id"], local_today)
+    if not due:
+        log.info("No events today for user %s", user_row["user_id"])
         return
-    await run_daily_for_user(context, user)
+    await deliver_due(context, user_row, due, wait=wait)
 
-async def run_daily_for_user(context: ContextTypes.DEFAULT_TYPE, user_row):
-    import os
+async def deliver_due(context: ContextTypes.DEFAULT_TYPE, user_row, due, wait: bool = False):
+    # user_row needs user_id, lat, lon and lang; due holds the event rows (id, title).
     owm_key = os.getenv("OWM_API_KEY")
     if not owm_key:
         log.error("OWM_API_KEY missing; cannot fetch weather.")
         return
     lang = user_lang_or_default(user_row, LANG_EN)
-    local_today = tz_now(user_row["timezone"]).date().isoformat()
-    due = get_events_for_date(user_row["user_id"], local_today)
-    if not due:
-        log.info("No events today for user %s", user_row["user_id"])
-        return
-    async with aiohttp.ClientSession() as session:
-        weather = await fetch_current_weather(session, owm_key, user_row["lat"], user_row["lon"])
-    for e in due:
-        if weather:
-            advice = make_advice(weather, lang)
-            details = format_weather_list(weather, lang)
-            message = f"{t(lang, 'today_you_have', title=e['title'])}\n{advice}\n\n{details}"
-        else:
-            message = f"{t(lang, 'today_you_have', title=e['title'])}\n{t(lang, 'weather_unavailable')}"
-        try:
-            await context.bot.send_message(chat_id=user_row["user_id"], text=message, parse_mode="Markdown")
-        except Exception as ex:
-            log.exception("Failed to send to %s: %s", user_row["user_id"], ex)
-        mark_notified(e["id"])
+    weather = await get_weather(owm_session(context), owm_key, user_row["lat"], user_row["lon"])
+    tail = render_weather(weather, lang) if weather else t(lang, "weather_unavailable")
+    if DAILY_DIGEST and len(due) > 1:
+        items = "\n".join(t(lang, "today_item", title=e["title"]) for e in due)
+        messages = [(f"{t(lang, 'today_you_have_list')}\n{items}\n{tail}", [e["id"] for e in due])]
+    else:
+        messages = [(f"{t(lang, 'today_you_have', title=e['title'])}\n{tail}", [e["id"]]) for e in due]
+    # Delivery is paced by the shared send queue, which marks the events notified right
+    # before each send; one another worker already took is skipped.
+    sent = [send_queue(context).send(user_row["user_id"], m, events=ids, parse_mode="Markdown")
+            for m, ids in messages]
+    if wait:
+        await asyncio.gather(*sent, return_exceptions=True)
+
+# ---------- Retention ----------
+async def archive_callback(context: ContextTypes.DEFAULT_TYPE):
+    # Each batch is its own short write, so interactive writes slot in between batches.
+    cutoff = (date.today() - timedelta(days=ARCHIVE_AFTER_DAYS)).isoformat()
+    moved = 0
+    while True:
+        n = await archive_events(cutoff, ARCHIVE_BATCH)
+        moved += n
+        if n < ARCHIVE_BATCH:
+            break
+    if moved:
+        freed = await reclaim_space(ARCHIVE_VACUUM_PAGES)
+        log.info("Archived %d event(s) dated before %s; released %d page(s)", moved, cutoff, freed)
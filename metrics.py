@@ -0,0 +1,169 @@
+import functools
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Optional
+
+from config import log
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+REGISTRY: list = []
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _labels(names: tuple, values: tuple, extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help: str, labels: tuple = ()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self._lock = threading.Lock()  # DB timings are recorded from worker threads
+        REGISTRY.append(self)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(labels.get(n, "") for n in self.label_names)
+
+    def render(self) -> list[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labels: tuple = ()):
+        super().__init__(name, help, labels)
+        self._values: dict[tuple, float] = {}
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def render(self) -> list[str]:
+        lines = super().render()
+        with self._lock:
+            items = list(self._values.items())
+        lines += [f"{self.name}{_labels(self.label_names, k)} {v}" for k, v in items]
+        return lines
+
+class Gauge(_Metric):
+    """A value read at scrape time from `fn` (set with set_function), or set directly."""
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str, fn: Optional[Callable[[], float]] = None):
+        super().__init__(name, help)
+        self._fn = fn
+        self._value = 0.0
+
+    def set(self, value: float):
+        self._value = value
+
+    def set_function(self, fn: Optional[Callable[[], float]]):
+        self._fn = fn
+
+    def render(self) -> list[str]:
+        try:
+            value = self._fn() if self._fn else self._value
+        except Exception:
+            value = float("nan")
+        return super().render() + [f"{self.name} {value}"]
+
+class CounterFunction(Gauge):
+    """A running total kept elsewhere, read at scrape time from `fn` (set with
+    set_function) and exported as a counter so rate()/increase() handle restarts."""
+    kind = "counter"
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+        self._series: dict[tuple, list] = {}  # key -> [bucket counts..., sum, count]
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def render(self) -> list[str]:
+        lines = super().render()
+        with self._lock:
+            items = [(k, list(v)) for k, v in self._series.items()]
+        for key, series in items:
+            bounds = [f'le="{b}"' for b in self.buckets] + ['le="+Inf"']
+            for le, n in zip(bounds, series[:-2] + [series[-1]]):
+                lines.append(f"{self.name}_bucket{_labels(self.label_names, key, le)} {n}")
+            lines.append(f"{self.name}_sum{_labels(self.label_names, key)} {series[-2]}")
+            lines.append(f"{self.name}_count{_labels(self.label_names, key)} {series[-1]}")
+        return lines
+
+def render() -> str:
+    return "\n".join(line for m in REGISTRY for line in m.render()) + "\n"
+
+# ---------- the bot's metrics ----------
+COMMAND_SECONDS = Histogram("bot_command_seconds", "Time to handle a bot command", ("command",))
+OWM_SECONDS = Histogram("owm_request_seconds", "OpenWeatherMap request latency", ("endpoint",))
+OWM_REQUESTS = Counter("owm_requests_total", "OpenWeatherMap requests by outcome", ("endpoint", "outcome"))
+DB_SECONDS = Histogram("db_query_seconds", "Time executing a database query", ("query",))
+SCHEDULER_LAG = Histogram("scheduler_lag_seconds", "Daily run start minus its 08:00 local target",
+                          buckets=(0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 15.0, 60.0, 300.0, 900.0, 3600.0))
+SEND_QUEUE_DEPTH = Gauge("send_queue_depth", "Messages waiting in the outbound send queue")
+WEATHER_CACHE_HITS = CounterFunction("weather_cache_hits_total", "Weather cache hits")
+WEATHER_CACHE_MISSES = CounterFunction("weather_cache_misses_total", "Weather cache misses")
+USER_CACHE_HITS = CounterFunction("user_cache_hits_total", "User profile cache hits")
+USER_CACHE_MISSES = CounterFunction("user_cache_misses_total", "User profile cache misses")
+OWM_CIRCUIT_OPEN = Gauge("owm_circuit_open", "1 while weather lookups are failing fast")
+DATE_FAST_HITS = CounterFunction("date_fast_path_hits_total", "Relative dates resolved without dateparser")
+DATE_FAST_MISSES = CounterFunction("date_fast_path_misses_total", "Dates handed to dateparser")
+PARSER_REJECTED = CounterFunction("date_parser_rejected_total", "Natural-language dates turned away with the parser queue full")
+PARSER_TIMEOUTS = CounterFunction("date_parser_timeouts_total", "Natural-language parses that ran past PARSER_TIMEOUT")
+
+def timed_command(command: str):
+    # Records a handler's latency in COMMAND_SECONDS under `command`.
+    def deco(fn):
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            with COMMAND_SECONDS.time(command=command):
+                return await fn(*args, **kwargs)
+        return wrapper
+    return deco
+
+# ---------- HTTP endpoint ----------
+async def start_metrics_server(host: str, port: int):
+    from aiohttp import web
+
+    async def handle(request):
+        return web.Response(body=render().encode(),
+                            headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    log.info("Metrics on http://%s:%d/metrics", host, port)
+    return runner
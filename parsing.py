@@ -1,10 +1,82 @@
+import asyncio
+import multiprocessing
 import re
-import dateparser
-from datetime import date
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import date, timedelta
+from config import log, PARSER_WORKERS, PARSER_QUEUE, PARSER_TIMEOUT
+from tztools import tz_now
 
 DATE_RE = re.compile(r"(\d{1,2})[.\-/](\d{1,2})[.\-/](\d{4})")
 
-def parse_event_args(text: str, tz_name: str, lang: str) -> tuple[str, date] | None:
+# ---------- fast path for common relative dates ----------
+# The phrase has to end the message ("Dentist tomorrow", "Встреча в пятницу");
+# everything before it is the title. Anything else goes to dateparser.
+WEEKDAYS = {
+    "monday": 0, "tuesday": 1, "wednesday": 2, "thursday": 3, "friday": 4, "saturday": 5, "sunday": 6,
+    "понедельник": 0, "вторник": 1, "среду": 2, "среда": 2, "четверг": 3,
+    "пятницу": 4, "пятница": 4, "субботу": 5, "суббота": 5, "воскресенье": 6,
+}
+# Only after on/next/this: alone they are ordinary words ("Walk in the sun").
+WEEKDAY_ABBREVIATIONS = {"mon": 0, "tue": 1, "wed": 2, "thu": 3, "fri": 4, "sat": 5, "sun": 6}
+OFFSET_WORDS = {
+    "today": 0, "tonight": 0, "tomorrow": 1, "day after tomorrow": 2,
+    "сегодня": 0, "завтра": 1, "послезавтра": 2,
+}
+
+def _alt(words) -> str:
+    return "|".join(re.escape(w) for w in sorted(words, key=len, reverse=True))
+
+FAST_RULES = {
+    "en": re.compile(rf"""
+        (?:^|\s)(?:
+            (?P<offset>today|tonight|tomorrow|day\s+after\s+tomorrow)
+          | in\s+(?P<n>\d{{1,3}}|an?|one)\s+(?P<unit>days?|weeks?)
+          | (?:on\s+)?(?:(?:next|this|coming)\s+)?(?P<wd>{_alt(w for w in WEEKDAYS if w.isascii())})
+          | (?:on\s+|(?:on\s+)?(?:next|this|coming)\s+)(?P<abbr>{_alt(WEEKDAY_ABBREVIATIONS)})
+        )\s*[.!]?\s*$""", re.IGNORECASE | re.VERBOSE),
+    "ru": re.compile(rf"""
+        (?:^|\s)(?:
+            (?P<offset>сегодня|завтра|послезавтра)
+          | через\s+(?:(?P<n>\d{{1,3}})\s+)?(?P<unit>день|дн(?:я|ей)|недел(?:ю|и|ь))
+          | (?:(?:в|во|на)\s+)?(?:(?:следующ(?:ий|ую|ее|ая)|эт(?:от|у|о))\s+)?(?P<wd>{_alt(w for w in WEEKDAYS if not w.isascii())})
+        )\s*[.!]?\s*$""", re.IGNORECASE | re.VERBOSE),
+}
+
+FAST_PATH_STATS = {"hit": 0, "miss": 0}
+
+def untitled(lang: str) -> str:
+    return "Untitled event" if lang == "en" else "Без названия"
+
+def parse_relative_date(text: str, tz_name: str, lang: str) -> tuple[str, date] | None:
+    order = ("en", "ru") if lang == "en" else ("ru", "en")
+    for rule_lang in order:
+        m = FAST_RULES[rule_lang].search(text)
+        if m:
+            break
+    else:
+        return None
+
+    today = tz_now(tz_name).date()
+    if m["offset"]:
+        d = today + timedelta(days=OFFSET_WORDS[" ".join(m["offset"].lower().split())])
+    elif m["unit"]:
+        n = m["n"] or "1"
+        n = int(n) if n.isdigit() else 1
+        d = today + timedelta(days=n * (7 if m["unit"].lower().startswith(("week", "нед")) else 1))
+    else:
+        # Weekday names mean the next such day, never today.
+        weekday = WEEKDAYS[m["wd"].lower()] if m["wd"] else WEEKDAY_ABBREVIATIONS[m["abbr"].lower()]
+        ahead = (weekday - today.weekday() - 1) % 7 + 1
+        d = today + timedelta(days=ahead)
+
+    title = text[:m.start()].strip().strip('"“”')
+    return (title or untitled(lang)), d
+
+NEEDS_DATEPARSER = object()
+
+def _parse_quick(text: str, tz_name: str, lang: str):
+    # Returns (title, date), None for an invalid explicit date, or NEEDS_DATEPARSER.
     # 1) Explicit dd.mm.yyyy / dd-mm-yyyy / dd/mm/yyyy
     m = DATE_RE.search(text)
     if m:
@@ -14,9 +86,15 @@ def parse_event_args(text: str, tz_name: str, lang: str) -> tuple[str, date] | N
         except ValueError:
             return None
         title = (text[:m.start()] + text[m.end():]).strip().strip('"“”')
-        return (title or ("Untitled event" if lang == "en" else "Без названия")), d
+        return (title or untitled(lang)), d
+
+    # 2) Common relative phrases, resolved without dateparser
+    fast = parse_relative_date(text, tz_name, lang)
+    FAST_PATH_STATS["hit" if fast else "miss"] += 1
+    return fast or NEEDS_DATEPARSER
 
-    # 2) Natural language (use user's timezone + language)
+def parse_natural_date(text: str, tz_name: str, lang: str) -> tuple[str, date] | None:
+    # 3) Natural language (use user's timezone + language)
     settings = {
         "TIMEZONE": tz_name,
         "RETURN_AS_TIMEZONE_AWARE": True,
@@ -24,6 +102,7 @@ def parse_event_args(text: str, tz_name: str, lang: str) -> tuple[str, date] | N
     }
     # IMPORTANT: pass languages via the parameter, not in settings
     langs = ["en"] if lang == "en" else ["ru"]
+    import dateparser  # slow to import; deferred until the first natural-language date
     dt = dateparser.parse(text, settings=settings, languages=langs)
     if not dt:
         return None
@@ -35,8 +114,96 @@ def parse_event_args(text: str, tz_name: str, lang: str) -> tuple[str, date] | N
             " ".join(parts[:-2]) if len(parts) >= 3 else None,
             " ".join(parts[:-3]) if len(parts) >= 4 else None,
         ]
-        title = next((c for c in candidates if c and len(c) >= 2), None) or ("Untitled event" if lang == "en" else "Без названия")
+        title = next((c for c in candidates if c and len(c) >= 2), None) or untitled(lang)
     else:
-        title = "Untitled event" if lang == "en" else "Без названия"
+        title = untitled(lang)
 
     return title, dt.date()
+
+def warm_up():
+    # Import dateparser and load the en/ru language data ahead of the first real request.
+    import dateparser
+    for lang in ("en", "ru"):
+        dateparser.parse("1", languages=[lang])
+
+# ---------- dateparser process pool ----------
+# dateparser is CPU-bound, so natural-language dates are parsed in worker processes
+# that import it and load the en/ru data once (warm_up) when they start.
+_pool: ProcessPoolExecutor | None = None
+_slots: asyncio.Semaphore | None = None
+_workers = 0
+POOL_STATS = {"parsed": 0, "rejected": 0, "timeout": 0, "failed": 0}
+
+def _ready() -> bool:
+    return True
+
+def _new_pool(workers: int) -> ProcessPoolExecutor:
+    pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"),
+                               initializer=warm_up)
+    for _ in range(workers):
+        pool.submit(_ready)  # start every worker now rather than on the first request
+    return pool
+
+def start_parser_pool(workers: int = PARSER_WORKERS, queue: int = PARSER_QUEUE):
+    global _pool, _slots, _workers
+    _workers = workers
+    _pool = _new_pool(workers)
+    _slots = asyncio.Semaphore(workers + queue)
+
+def stop_parser_pool():
+    global _pool, _slots
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+    _pool = _slots = None
+
+def _replace_broken(pool: ProcessPoolExecutor, ex: BrokenProcessPool):
+    # A worker that dies (e.g. OOM-killed) breaks the executor for good; start a fresh one.
+    global _pool
+    POOL_STATS["failed"] += 1
+    log.error("Date parser pool is broken: %s", ex)
+    if _pool is pool:
+        pool.shutdown(wait=False, cancel_futures=True)
+        _pool = _new_pool(_workers)
+        log.warning("Date parser pool restarted")
+
+def _release_when_done(loop: asyncio.AbstractEventLoop, slots: asyncio.Semaphore):
+    def release(_):
+        try:
+            loop.call_soon_threadsafe(slots.release)
+        except RuntimeError:  # loop already closed
+            pass
+    return release
+
+async def parse_event_args_async(text: str, tz_name: str, lang: str) -> tuple[str, date] | None:
+    quick = _parse_quick(text, tz_name, lang)
+    if quick is not NEEDS_DATEPARSER:
+        return quick
+    loop = asyncio.get_running_loop()
+    if _pool is None:
+        return await loop.run_in_executor(None, parse_natural_date, text, tz_name, lang)
+    if _slots.locked():
+        POOL_STATS["rejected"] += 1
+        log.warning("Date parser pool is full; rejecting %r", text)
+        return None
+    pool, slots = _pool, _slots
+    await slots.acquire()
+    try:
+        job = pool.submit(parse_natural_date, text, tz_name, lang)
+    except BrokenProcessPool as ex:
+        slots.release()
+        _replace_broken(pool, ex)
+        return None
+    # The slot is freed when the worker is done with the job, not when we stop waiting,
+    # so parses that timed out still count against PARSER_QUEUE.
+    job.add_done_callback(_release_when_done(loop, slots))
+    try:
+        result = await asyncio.wait_for(asyncio.wrap_future(job), PARSER_TIMEOUT)
+    except asyncio.TimeoutError:
+        POOL_STATS["timeout"] += 1
+        log.warning("Date parsing timed out after %.1fs: %r", PARSER_TIMEOUT, text)
+        return None
+    except BrokenProcessPool as ex:
+        _replace_broken(pool, ex)
+        return None
+    POOL_STATS["parsed"] += 1
+    return result
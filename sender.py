@@ -0,0 +1,235 @@
+import asyncio
+import heapq
+import itertools
+import time
+from collections import deque
+from typing import Optional
+from telegram.error import RetryAfter
+
+from config import (
+    log, SEND_RATE, SEND_BURST, SEND_CHAT_INTERVAL, SEND_WORKERS, SEND_MAX_RETRIES
+)
+
+class TokenBucket:
+    """Global send budget: `rate` tokens per second, up to `burst` saved up."""
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._stamp = time.monotonic()
+        self._paused_until = 0.0
+
+    def pause(self, seconds: float):
+        # Flood control from Telegram applies to the whole bot, so stop everyone.
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0.0
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            if now < self._paused_until:
+                await asyncio.sleep(self._paused_until - now)
+                continue
+            self._tokens = min(self.burst, self._tokens + (now - self._stamp) * self.rate)
+            self._stamp = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            await asyncio.sleep((1 - self._tokens) / self.rate)
+
+def _seconds(retry_after) -> float:
+    # PTB reports retry_after as int seconds (or a timedelta in newer releases).
+    return retry_after.total_seconds() if hasattr(retry_after, "total_seconds") else float(retry_after)
+
+async def _see_through(coro):
+    # Lets a started claim or HTTP call finish even if the caller is cancelled meanwhile,
+    # so its outcome is known; the cancellation is re-raised afterwards.
+    task = asyncio.ensure_future(coro)
+    try:
+        return await asyncio.shield(task)
+    except asyncio.CancelledError:
+        await asyncio.wait([task])
+        raise
+
+class _Outgoing:
+    __slots__ = ("text", "kwargs", "fut", "events", "claimed", "sent")
+
+    def __init__(self, text: str, kwargs: dict, fut: asyncio.Future, events: Optional[list[int]]):
+        self.text = text
+        self.kwargs = kwargs
+        self.fut = fut
+        self.events = events
+        self.claimed: list[int] = []
+        self.sent = None  # the Message once Telegram has accepted it
+
+class SendQueue:
+    """Outbound message pipeline shared by the daily runs.
+
+    `send()` only enqueues; worker tasks deliver at most `rate` messages per second
+    overall, at most one per `chat_interval` seconds to the same chat, and retry after
+    the delay Telegram asks for on flood errors. The returned future resolves to the
+    sent Message, or None if delivery failed or was skipped.
+
+    A message sent with `events` is only delivered once a worker has claimed those ids
+    through `claim` (db.claim_events), right before sending; if none can be claimed
+    (another process got there first) it is skipped. Queued messages hold no claims,
+    so a stop that leaves them unsent leaves their events pending.
+
+    Each chat has its own FIFO and sits in a heap keyed by the time it may be sent to
+    next, so a chat that has to wait doesn't hold a worker while others are ready.
+    """
+
+    def __init__(self, bot, rate: float = SEND_RATE, burst: int = SEND_BURST,
+                 chat_interval: float = SEND_CHAT_INTERVAL, workers: int = SEND_WORKERS,
+                 max_retries: int = SEND_MAX_RETRIES, claim=None):
+        self.bot = bot
+        self._claim = claim
+        self.chat_interval = chat_interval
+        self.max_retries = max_retries
+        self._bucket = TokenBucket(rate, burst)
+        self._chats: dict[int, deque] = {}         # chat_id -> pending _Outgoing
+        self._ready: list[tuple[float, int, int]] = []  # (ready at, seq, chat_id), one entry per waiting chat
+        self._seq = itertools.count()
+        self._next_slot: dict[int, float] = {}     # chat_id -> earliest time of its next message
+        self._wakeup = asyncio.Event()
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._unfinished = 0
+        self._queued = 0
+        self._n_workers = workers
+        self._workers: list[asyncio.Task] = []
+
+    def start(self):
+        for i in range(self._n_workers):
+            self._workers.append(asyncio.create_task(self._worker(), name=f"send-worker-{i}"))
+
+    async def stop(self, timeout: float = 10.0) -> list[tuple[int, str, list[int]]]:
+        """Wait up to `timeout` seconds for the queue to drain, then stop the workers.
+
+        Returns (chat_id, text, claimed event ids) for every message that never went out;
+        their futures are cancelled. A claim or send already under way is let finish first.
+        The ids are only non-empty for messages claimed but not sent, and are the caller's
+        to release.
+        """
+        try:
+            await asyncio.wait_for(self.join(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        for task in self._workers:
+            task.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers.clear()
+        unsent = []
+        for chat_id, pending in self._chats.items():
+            for out in pending:
+                out.fut.cancel()
+                unsent.append((chat_id, out.text, out.claimed))
+        self._chats.clear()
+        self._ready.clear()
+        self._queued = self._unfinished = 0
+        self._idle.set()
+        if unsent:
+            log.warning("Send queue stopped with %d message(s) undelivered", len(unsent))
+        return unsent
+
+    async def join(self):
+        # Wait until everything queued so far has been delivered (or given up on).
+        await self._idle.wait()
+
+    def depth(self) -> int:
+        return self._queued
+
+    def send(self, chat_id: int, text: str, events: Optional[list[int]] = None, **kwargs) -> asyncio.Future:
+        fut = asyncio.get_running_loop().create_future()
+        pending = self._chats.get(chat_id)
+        if pending is None:
+            # Not waiting in the heap and not being sent to right now
+            pending = self._chats[chat_id] = deque()
+            self._schedule(chat_id, max(time.monotonic(), self._next_slot.get(chat_id, 0.0)))
+        pending.append(_Outgoing(text, kwargs, fut, events))
+        self._queued += 1
+        self._unfinished += 1
+        self._idle.clear()
+        return fut
+
+    def _schedule(self, chat_id: int, ready_at: float):
+        heapq.heappush(self._ready, (ready_at, next(self._seq), chat_id))
+        self._wakeup.set()
+
+    async def _next_chat(self) -> int:
+        while True:
+            delay = None
+            if self._ready:
+                ready_at, _, chat_id = self._ready[0]
+                delay = ready_at - time.monotonic()
+                if delay <= 0:
+                    heapq.heappop(self._ready)
+                    return chat_id
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _worker(self):
+        while True:
+            chat_id = await self._next_chat()
+            pending = self._chats[chat_id]
+            out = pending.popleft()
+            self._queued -= 1
+            try:
+                msg = await self._deliver(chat_id, out)
+                if not out.fut.done():
+                    out.fut.set_result(msg)
+            except asyncio.CancelledError:
+                if out.sent is not None:
+                    out.fut.set_result(out.sent)
+                else:
+                    pending.appendleft(out)  # stop() reports it as unsent, with what it claimed
+                raise
+            finally:
+                # Counted from when the send finished, so bucket waits can't bunch a chat's messages.
+                now = time.monotonic()
+                next_at = self._next_slot[chat_id] = now + self.chat_interval
+                if len(self._next_slot) > 10000:
+                    self._next_slot = {k: v for k, v in self._next_slot.items() if v > now}
+                if pending:
+                    self._schedule(chat_id, next_at)
+                else:
+                    del self._chats[chat_id]
+                self._unfinished -= 1
+                if not self._unfinished:
+                    self._idle.set()
+
+    async def _take(self, out: _Outgoing):
+        try:
+            out.claimed = await self._claim(out.events)
+        except Exception as ex:
+            log.exception("Failed to claim events %s: %s", out.events, ex)
+
+    async def _post(self, chat_id: int, out: _Outgoing):
+        out.sent = await self.bot.send_message(chat_id=chat_id, text=out.text, **out.kwargs)
+        return out.sent
+
+    async def _deliver(self, chat_id: int, out: _Outgoing) -> Optional[object]:
+        for attempt in range(self.max_retries + 1):
+            await self._bucket.acquire()
+            if out.events and self._claim and not out.claimed:
+                # Claimed only once the send can go ahead, so waiting messages hold no claims.
+                # A digest goes out if it claims any of its events; the rest were sent elsewhere.
+                await _see_through(self._take(out))
+                if not out.claimed:
+                    return None
+            try:
+                return await _see_through(self._post(chat_id, out))
+            except RetryAfter as ex:
+                delay = _seconds(ex.retry_after)
+                log.warning("Flood control on %s, retrying in %.1fs (attempt %d)", chat_id, delay, attempt + 1)
+                self._bucket.pause(delay)
+                await asyncio.sleep(delay)
+            except Exception as ex:
+                log.exception("Failed to send to %s: %s", chat_id, ex)
+                return None
+        log.error("Giving up on %s after %d flood-control retries", chat_id, self.max_retries)
+        return None
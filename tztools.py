@@ -1,11 +1,37 @@
-from datetime import datetime
+import functools
+import threading
+from datetime import datetime, date, timezone
 from zoneinfo import ZoneInfo
-from timezonefinder import TimezoneFinder
+from config import TZ_LOOKUP_GRID, TZ_LOOKUP_CACHE_SIZE
 
-TF = TimezoneFinder()
+# TimezoneFinder loads its polygon data on construction, so it is created on first use.
+_tf = None
+_tf_lock = threading.Lock()
+
+def timezone_finder():
+    global _tf
+    if _tf is None:
+        with _tf_lock:
+            if _tf is None:
+                from timezonefinder import TimezoneFinder
+                _tf = TimezoneFinder()
+    return _tf
+
+@functools.lru_cache(maxsize=TZ_LOOKUP_CACHE_SIZE)
+def _timezone_at_cell(qlat: int, qlon: int) -> str:
+    return timezone_finder().timezone_at(lat=qlat * TZ_LOOKUP_GRID, lng=qlon * TZ_LOOKUP_GRID) or "UTC"
 
 def detect_timezone_name(lat: float, lon: float) -> str:
-    return TF.timezone_at(lat=lat, lng=lon) or "UTC"
+    # Coordinates are snapped to a TZ_LOOKUP_GRID-degree grid so nearby points share one lookup.
+    return _timezone_at_cell(round(lat / TZ_LOOKUP_GRID), round(lon / TZ_LOOKUP_GRID))
+
+@functools.lru_cache(maxsize=1024)
+def get_zone(tz_name: str) -> ZoneInfo:
+    return ZoneInfo(tz_name)
 
 def tz_now(tz_name: str) -> datetime:
-    return datetime.now(ZoneInfo(tz_name))
+    return datetime.now(get_zone(tz_name))
+
+def local_date(tz_name: str, instant: datetime | None = None) -> date:
+    # The calendar date in tz_name at `instant` (an aware datetime; defaults to now).
+    return (instant or datetime.now(timezone.utc)).astimezone(get_zone(tz_name)).date()
@@ -1,9 +1,18 @@
+import asyncio
+import functools
+import time
+from collections import OrderedDict
 from dataclasses import dataclass
 from typing import Optional
 import aiohttp
-from config import t, LANG_EN, log
+from metrics import OWM_SECONDS, OWM_REQUESTS
+from config import (
+    t, LANG_EN, log, OWM_BASE_URL, WEATHER_CACHE_TTL, WEATHER_CACHE_SIZE, WEATHER_CACHE_GRID,
+    OWM_POOL_LIMIT, OWM_POOL_PER_HOST, OWM_DNS_CACHE_TTL, OWM_KEEPALIVE, OWM_TIMEOUT, OWM_CONNECT_TIMEOUT,
+    OWM_BREAKER_FAILURES, OWM_BREAKER_COOLDOWN, OWM_BREAKER_MAX_COOLDOWN
+)
 
-@dataclass
+@dataclass(frozen=True)
 class WeatherSummary:
     temp: Optional[float]
     feels_like: Optional[float]
@@ -18,25 +27,49 @@ def _mm_from(obj: Optional[dict]) -> float:
         return 0.0
     return float(obj.get("1h") or obj.get("3h") or 0.0)
 
+def create_owm_session() -> aiohttp.ClientSession:
+    # Must be called from a running event loop; owned and closed by the Application.
+    connector = aiohttp.TCPConnector(
+        limit=OWM_POOL_LIMIT,
+        limit_per_host=OWM_POOL_PER_HOST,
+        ttl_dns_cache=OWM_DNS_CACHE_TTL,
+        keepalive_timeout=OWM_KEEPALIVE,
+    )
+    timeout = aiohttp.ClientTimeout(total=OWM_TIMEOUT, connect=OWM_CONNECT_TIMEOUT)
+    return aiohttp.ClientSession(connector=connector, timeout=timeout)
+
 async def geocode_city(session: aiohttp.ClientSession, api_key: str, city: str):
-    url = "https://api.openweathermap.org/geo/1.0/direct"
+    url = f"{OWM_BASE_URL}/geo/1.0/direct"
     params = {"q": city, "limit": 1, "appid": api_key}
-    async with session.get(url, params=params, timeout=20) as resp:
-        resp.raise_for_status()
-        data = await resp.json()
-        if not data:
-            return None
-        top = data[0]
-        return {"name": f"{top.get('name')}, {top.get('country')}", "lat": top["lat"], "lon": top["lon"]}
+    with OWM_SECONDS.time(endpoint="geocode"):
+        try:
+            async with session.get(url, params=params) as resp:
+                resp.raise_for_status()
+                data = await resp.json()
+        except Exception:
+            OWM_REQUESTS.inc(endpoint="geocode", outcome="error")
+            raise
+    OWM_REQUESTS.inc(endpoint="geocode", outcome="ok")
+    if not data:
+        return None
+    top = data[0]
+    return {"name": f"{top.get('name')}, {top.get('country')}", "lat": top["lat"], "lon": top["lon"]}
 
 async def fetch_current_weather(session: aiohttp.ClientSession, api_key: str, lat: float, lon: float) -> Optional[WeatherSummary]:
-    url = "https://api.openweathermap.org/data/2.5/weather"
+    url = f"{OWM_BASE_URL}/data/2.5/weather"
     params = {"lat": lat, "lon": lon, "appid": api_key, "units": "metric", "lang": "en"}
-    async with session.get(url, params=params, timeout=20) as resp:
-        if resp.status != 200:
-            log.warning("OWM current weather failed: %s", await resp.text())
-            return None
-        j = await resp.json()
+    with OWM_SECONDS.time(endpoint="weather"):
+        try:
+            async with session.get(url, params=params) as resp:
+                if resp.status != 200:
+                    OWM_REQUESTS.inc(endpoint="weather", outcome="error")
+                    log.warning("OWM current weather failed: %s", await resp.text())
+                    return None
+                j = await resp.json()
+        except Exception:
+            OWM_REQUESTS.inc(endpoint="weather", outcome="error")
+            raise
+    OWM_REQUESTS.inc(endpoint="weather", outcome="ok")
 
     condition = (j.get("weather") or [{}])[0].get("description", "weather unavailable")
     main = j.get("main") or {}
@@ -52,6 +85,153 @@ async def fetch_current_weather(session: aiohttp.ClientSession, api_key: str, la
         snow_mm=_mm_from(j.get("snow")),
     )
 
+# ---------- cache ----------
+class WeatherCache:
+    """LRU of WeatherSummary keyed by a lat/lon grid cell; entries expire after `ttl` seconds."""
+
+    def __init__(self, ttl: float, max_size: int, grid: float):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.grid = grid
+        self.hits = 0
+        self.misses = 0
+        self._data: OrderedDict[tuple[int, int], tuple[float, WeatherSummary]] = OrderedDict()
+
+    def key(self, lat: float, lon: float) -> tuple[int, int]:
+        return round(lat / self.grid), round(lon / self.grid)
+
+    def get(self, lat: float, lon: float) -> Optional[WeatherSummary]:
+        k = self.key(lat, lon)
+        item = self._data.get(k)
+        if item is None or item[0] < time.monotonic():
+            if item is not None:
+                del self._data[k]
+            self.misses += 1
+            return None
+        self._data.move_to_end(k)
+        self.hits += 1
+        return item[1]
+
+    def put(self, lat: float, lon: float, w: WeatherSummary, ttl: Optional[float] = None):
+        k = self.key(lat, lon)
+        self._data[k] = (time.monotonic() + (self.ttl if ttl is None else ttl), w)
+        self._data.move_to_end(k)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+WEATHER_CACHE = WeatherCache(WEATHER_CACHE_TTL, WEATHER_CACHE_SIZE, WEATHER_CACHE_GRID)
+
+# ---------- circuit breaker ----------
+class CircuitBreaker:
+    """Opens after `threshold` failures in a row; while open, callers fail fast.
+
+    Recovery is checked off the request path: a background probe retries every `cooldown`
+    seconds (doubling up to `max_cooldown`) and closes the breaker on its first success.
+    """
+
+    def __init__(self, threshold: int, cooldown: float, max_cooldown: float):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self._probe_task: Optional[asyncio.Task] = None
+
+    @property
+    def is_open(self) -> bool:
+        return self.opened_at is not None
+
+    def success(self):
+        if self.opened_at is not None:
+            log.info("OWM circuit closed after %.0fs", time.monotonic() - self.opened_at)
+        self.failures = 0
+        self.opened_at = None
+
+    def failure(self, probe):
+        # `probe` is an async callable returning True once the upstream works again.
+        self.failures += 1
+        if self.opened_at is not None or self.failures < self.threshold:
+            return
+        self.opened_at = time.monotonic()
+        log.warning("OWM circuit opened after %d failures in a row", self.failures)
+        if self._probe_task is None or self._probe_task.done():
+            self._probe_task = asyncio.create_task(self._probe(probe), name="owm-probe")
+
+    async def _probe(self, probe):
+        delay = self.cooldown
+        while self.opened_at is not None:
+            await asyncio.sleep(delay)
+            try:
+                ok = await probe()
+            except Exception as ex:
+                log.debug("OWM probe failed: %s", ex)
+                ok = False
+            if ok:
+                self.success()
+                return
+            delay = min(delay * 2, self.max_cooldown)
+
+    def stop(self):
+        if self._probe_task is not None:
+            self._probe_task.cancel()
+            self._probe_task = None
+
+OWM_BREAKER = CircuitBreaker(OWM_BREAKER_FAILURES, OWM_BREAKER_COOLDOWN, OWM_BREAKER_MAX_COOLDOWN)
+
+async def _fetch_and_cache(session: aiohttp.ClientSession, api_key: str, lat: float, lon: float,
+                           ttl: Optional[float] = None) -> Optional[WeatherSummary]:
+    try:
+        w = await fetch_current_weather(session, api_key, lat, lon)
+    except Exception as ex:
+        log.warning("OWM current weather failed for %.2f,%.2f: %s", lat, lon, ex)
+        w = None
+    if w is None:
+        async def probe():
+            return await fetch_current_weather(session, api_key, lat, lon) is not None
+        OWM_BREAKER.failure(probe)
+        return None
+    OWM_BREAKER.success()
+    WEATHER_CACHE.put(lat, lon, w, ttl=ttl)
+    return w
+
+# ---------- lookups ----------
+_inflight: dict[tuple[int, int], asyncio.Future] = {}
+
+async def get_weather(session: aiohttp.ClientSession, api_key: str, lat: float, lon: float) -> Optional[WeatherSummary]:
+    # Cached report, else one shared request per grid cell; None while OWM is failing.
+    w = WEATHER_CACHE.get(lat, lon)
+    if w is not None:
+        return w
+    if OWM_BREAKER.is_open:
+        OWM_REQUESTS.inc(endpoint="weather", outcome="short_circuit")
+        return None
+    k = WEATHER_CACHE.key(lat, lon)
+    fut = _inflight.get(k)
+    if fut is None:
+        fut = _inflight[k] = asyncio.ensure_future(_fetch_and_cache(session, api_key, lat, lon))
+        fut.add_done_callback(lambda _: _inflight.pop(k, None))
+    # Shielded so one cancelled waiter doesn't cancel the request for everyone else.
+    return await asyncio.shield(fut)
+
+async def prefetch_weather(session: aiohttp.ClientSession, api_key: str, locations, rate: float, ttl: float) -> int:
+    # Fetches one report per grid cell, starting at most `rate` requests per second, and
+    # caches each for `ttl` seconds. Returns how many cells were stored.
+    cells = {}
+    for lat, lon in locations:
+        cells.setdefault(WEATHER_CACHE.key(lat, lon), (lat, lon))
+
+    async def fetch(lat: float, lon: float, delay: float) -> bool:
+        await asyncio.sleep(delay)
+        if OWM_BREAKER.is_open:
+            return False
+        return await _fetch_and_cache(session, api_key, lat, lon, ttl=ttl) is not None
+
+    results = await asyncio.gather(*(fetch(lat, lon, i / rate) for i, (lat, lon) in enumerate(cells.values())))
+    return sum(results)
+
 def make_advice(w: WeatherSummary, lang: str) -> str:
     tips = []
     c = (w.condition or "").lower()
@@ -105,3 +285,8 @@ def format_weather_list(w: WeatherSummary, lang: str) -> str:
     if w.snow_mm > 0:
         parts.append(t(lang, "w_snow", mm=w.snow_mm))
     return "\n".join(parts)
+
+@functools.lru_cache(maxsize=4096)
+def render_weather(w: WeatherSummary, lang: str) -> str:
+    # Advice plus details; everyone sharing a snapshot and language gets the same block.
+    return f"{make_advice(w, lang)}\n\n{format_weather_list(w, lang)}"